@@ -31,11 +31,11 @@ MODEL_CONFIG = {
 }
 
 
-def load_model(model_path):
+def load_model(model_path, providers=None):
     session_options = ort.SessionOptions()
     session = ort.InferenceSession(
         model_path,
-        providers=["CUDAExecutionProvider"],
+        providers=providers or ["CUDAExecutionProvider"],
         sess_options=session_options,
     )
 
@@ -59,7 +59,14 @@ def get_predictions(model, image_array, input_name):
     return outputs[0], (time.time() - start_time) * 1000
 
 
-def evaluate_model(model_name, model, image_dir, input_shape, input_mode: str):
+def evaluate_model(
+    model_name,
+    model,
+    image_dir,
+    input_shape,
+    input_mode: str,
+    results_dir: str = "./results",
+):
     key_list = list(IMAGENET2012_CLASSES.keys())
     input_name = model.get_inputs()[0].name
     images_list = os.listdir(image_dir)[:1000]
@@ -81,7 +88,7 @@ def evaluate_model(model_name, model, image_dir, input_shape, input_mode: str):
 
             data.append([file, synset_id, key_at_index, latency])
 
-    csv_file_path = f"./results/{model_name}.csv"
+    csv_file_path = f"{results_dir}/{model_name}.csv"
     with open(csv_file_path, mode="w", newline="") as file:
         writer = csv.writer(file)
         writer.writerow(["Filename", "Ground Truth", "Prediction", "Latency (ms)"])
@@ -0,0 +1,202 @@
+"""
+Prepend the input normalization of each model to its ONNX graph.
+
+The resulting `./onnx_model/{model}_uint8.onnx` takes the raw uint8 NHWC image
+and performs the cast, the channel flip (caffe) and the per-channel scale and
+offset of its `input_mode` inside the graph, so the inference service can feed
+the request buffer to session.run without any Python-side preprocessing.
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import onnx
+import onnxruntime as ort
+from onnx import TensorProto, helper, numpy_helper
+
+from preprocessing import preprocess_input
+
+MODEL_CONFIG = {
+    "DenseNet121": [(1, 224, 224, 3), "torch"],
+    "DenseNet201": [(1, 224, 224, 3), "torch"],
+    "EfficientNetB0": [(1, 224, 224, 3), "raw"],
+    "EfficientNetB7": [(1, 600, 600, 3), "raw"],
+    "EfficientNetV2L": [(1, 480, 480, 3), "raw"],
+    "EfficientNetV2S": [(1, 384, 384, 3), "raw"],
+    "InceptionResNetV2": [(1, 299, 299, 3), "tf"],
+    "InceptionV3": [(1, 299, 299, 3), "tf"],
+    "MobileNet": [(1, 224, 224, 3), "tf"],
+    "MobileNetV2": [(1, 224, 224, 3), "tf"],
+    "NASNetLarge": [(1, 331, 331, 3), "tf"],
+    "NASNetMobile": [(1, 224, 224, 3), "tf"],
+    "ResNet50": [(1, 224, 224, 3), "caffe"],
+    "ResNet50V2": [(1, 224, 224, 3), "tf"],
+    "VGG16": [(1, 224, 224, 3), "caffe"],
+    "Xception": [(1, 299, 299, 3), "tf"],
+}
+
+
+def normalization_constants(input_mode: str):
+    """Express each mode as `x[..., channels] * scale + offset`."""
+    channels = [0, 1, 2]
+    if input_mode == "tf":
+        scale = np.full(3, 1 / 127.5)
+        offset = np.full(3, -1.0)
+    elif input_mode == "torch":
+        mean = np.array([0.485, 0.456, 0.406])
+        std = np.array([0.229, 0.224, 0.225])
+        scale = 1 / (255.0 * std)
+        offset = -mean / std
+    elif input_mode == "caffe":
+        # 'RGB'->'BGR' then zero-center, without scaling
+        channels = [2, 1, 0]
+        scale = np.ones(3)
+        offset = -np.array([103.939, 116.779, 123.68])
+    elif input_mode == "raw":
+        return channels, None, None
+    else:
+        raise ValueError(f"Unknown input mode: {input_mode}")
+    return channels, scale.astype(np.float32), offset.astype(np.float32)
+
+
+def fuse_normalization(model: onnx.ModelProto, input_mode: str) -> onnx.ModelProto:
+    graph = model.graph
+    original_input = graph.input[0]
+    input_name = original_input.name
+    normalized_name = f"{input_name}_normalized"
+
+    # Everything that consumed the float input now consumes the normalized tensor
+    for node in graph.node:
+        for i, name in enumerate(node.input):
+            if name == input_name:
+                node.input[i] = normalized_name
+
+    channels, scale, offset = normalization_constants(input_mode)
+    nodes = []
+    initializers = []
+    current = f"{input_name}_float"
+    nodes.append(
+        helper.make_node(
+            "Cast", [input_name], [current], to=TensorProto.FLOAT, name="input_cast"
+        )
+    )
+    if channels != [0, 1, 2]:
+        initializers.append(
+            numpy_helper.from_array(
+                np.array(channels, dtype=np.int64), "input_channel_order"
+            )
+        )
+        nodes.append(
+            helper.make_node(
+                "Gather",
+                [current, "input_channel_order"],
+                [f"{input_name}_flipped"],
+                axis=3,
+                name="input_channel_flip",
+            )
+        )
+        current = f"{input_name}_flipped"
+    if scale is not None and not np.all(scale == 1):
+        initializers.append(numpy_helper.from_array(scale, "input_scale"))
+        nodes.append(
+            helper.make_node(
+                "Mul",
+                [current, "input_scale"],
+                [f"{input_name}_scaled"],
+                name="input_scale_mul",
+            )
+        )
+        current = f"{input_name}_scaled"
+    if offset is not None:
+        initializers.append(numpy_helper.from_array(offset, "input_offset"))
+        nodes.append(
+            helper.make_node(
+                "Add",
+                [current, "input_offset"],
+                [normalized_name],
+                name="input_offset_add",
+            )
+        )
+    else:
+        nodes.append(
+            helper.make_node(
+                "Identity", [current], [normalized_name], name="input_identity"
+            )
+        )
+
+    for node in reversed(nodes):
+        graph.node.insert(0, node)
+    graph.initializer.extend(initializers)
+    original_input.type.tensor_type.elem_type = TensorProto.UINT8
+
+    onnx.checker.check_model(model)
+    return model
+
+
+def verify(
+    model_path: str,
+    fused_path: str,
+    input_shape,
+    input_mode: str,
+    tolerance: float = 1e-4,
+):
+    """
+    Compare the fused model on uint8 input with the float model on Python
+    preprocessing, ValueError when the outputs differ by more than tolerance.
+    """
+    image = np.random.randint(0, 256, size=(2, *input_shape[1:]), dtype=np.uint8)
+
+    reference = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+    reference_input = preprocess_input(image.astype(np.float32), mode=input_mode)
+    expected = reference.run(None, {reference.get_inputs()[0].name: reference_input})[0]
+
+    fused = ort.InferenceSession(fused_path, providers=["CPUExecutionProvider"])
+    actual = fused.run(None, {fused.get_inputs()[0].name: image})[0]
+
+    max_diff = float(np.max(np.abs(expected - actual)))
+    print(f"Max absolute output difference: {max_diff:.2e}")
+    if not max_diff <= tolerance:
+        raise ValueError(
+            f"{fused_path} differs from {model_path} by {max_diff:.2e} "
+            f"(tolerance {tolerance:.0e})"
+        )
+    return max_diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model", help="model name, all models when omitted", default=None
+    )
+    parser.add_argument(
+        "--verify",
+        help="compare the fused model against the Python preprocessing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="max absolute output difference --verify accepts",
+        type=float,
+        default=1e-4,
+    )
+    args = parser.parse_args()
+
+    model_names = [args.model] if args.model else list(MODEL_CONFIG)
+    for model_name in model_names:
+        input_shape, input_mode = MODEL_CONFIG[model_name]
+        model_path = f"./onnx_model/{model_name}.onnx"
+        output_path = f"./onnx_model/{model_name}_uint8.onnx"
+
+        model = fuse_normalization(onnx.load(model_path), input_mode)
+        onnx.save(model, output_path)
+        print(
+            f"{model_name} with fused {input_mode} preprocessing saved to {output_path}"
+        )
+
+        if args.verify:
+            try:
+                verify(model_path, output_path, input_shape, input_mode, args.tolerance)
+            except ValueError as e:
+                # A broken fused model must fail the build
+                sys.exit(f"Verification failed: {e}")
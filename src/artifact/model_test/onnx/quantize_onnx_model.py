@@ -0,0 +1,198 @@
+"""
+Static INT8 (QDQ) quantization of the ONNX models with an accuracy guardrail.
+
+Each model is calibrated on a sample of the ImageNet validation images, then
+the FP32 and INT8 models are profiled with accuracy_profiling.py, writing
+`{results_dir}/{model}.csv` and `{results_dir}/{model}_int8.csv`. A model whose
+top-1 accuracy drops by more than `--max-accuracy-drop` percentage points fails
+the run. Serve an accepted model with `model_variant: int8` in
+inference_service_config.yaml.
+
+    python quantize_onnx_model.py --model MobileNetV2 EfficientNetB0 --image-dir ./data
+"""
+
+import argparse
+import csv
+import os
+import random
+import sys
+
+import numpy as np
+from accuracy_profiling import (
+    MODEL_CONFIG,
+    evaluate_model,
+    load_model,
+    preprocess_image,
+)
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    CalibrationMethod,
+    QuantFormat,
+    QuantType,
+    quant_pre_process,
+    quantize_static,
+)
+
+
+class ImageCalibrationDataReader(CalibrationDataReader):
+    def __init__(
+        self, image_paths: list[str], input_name: str, input_shape, input_mode
+    ):
+        self.image_paths = iter(image_paths)
+        self.input_name = input_name
+        self.input_shape = input_shape
+        self.input_mode = input_mode
+
+    def get_next(self):
+        image_path = next(self.image_paths, None)
+        if image_path is None:
+            return None
+        image_array = preprocess_image(image_path, self.input_shape, self.input_mode)
+        return {self.input_name: image_array}
+
+
+def calibration_images(image_dir: str, size: int, seed: int = 0) -> list[str]:
+    images = sorted(file for file in os.listdir(image_dir) if file.endswith(".JPEG"))
+    # NOTE: accuracy_profiling evaluates the first 1000 listed images, calibrate
+    # on the others when the directory has enough of them
+    evaluated = set(os.listdir(image_dir)[:1000])
+    candidates = [image for image in images if image not in evaluated]
+    if len(candidates) < size:
+        candidates = images
+    random.Random(seed).shuffle(candidates)
+    return [os.path.join(image_dir, image) for image in candidates[:size]]
+
+
+def quantize_model(
+    model_name: str,
+    model_dir: str,
+    image_dir: str,
+    calibration_size: int,
+    per_channel: bool,
+) -> str:
+    input_shape, input_mode = MODEL_CONFIG[model_name]
+    model_path = os.path.join(model_dir, f"{model_name}.onnx")
+    preprocessed_path = os.path.join(model_dir, f"{model_name}_preprocessed.onnx")
+    output_path = os.path.join(model_dir, f"{model_name}_int8.onnx")
+
+    # Shape inference and graph cleanup recommended before static quantization
+    quant_pre_process(model_path, preprocessed_path, skip_optimization=False)
+
+    input_name = load_model(model_path, ["CPUExecutionProvider"]).get_inputs()[0].name
+    reader = ImageCalibrationDataReader(
+        calibration_images(image_dir, calibration_size),
+        input_name,
+        input_shape,
+        input_mode,
+    )
+    quantize_static(
+        preprocessed_path,
+        output_path,
+        reader,
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=per_channel,
+        calibrate_method=CalibrationMethod.MinMax,
+    )
+    os.remove(preprocessed_path)
+    print(f"{model_name} quantized to {output_path}")
+    return output_path
+
+
+def read_profile(csv_file_path: str) -> tuple[float, float]:
+    """Top-1 accuracy (%) and mean latency (ms) of an accuracy_profiling CSV."""
+    with open(csv_file_path, newline="") as file:
+        rows = list(csv.DictReader(file))
+    correct = [row["Ground Truth"] == row["Prediction"] for row in rows]
+    # The first inference includes the lazy ORT initialization
+    latencies = [float(row["Latency (ms)"]) for row in rows[1:]]
+    return 100 * float(np.mean(correct)), float(np.mean(latencies))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", nargs="+", default=["MobileNetV2", "EfficientNetB0"])
+    parser.add_argument("--model-dir", default="./onnx_model")
+    parser.add_argument("--image-dir", default="./data")
+    parser.add_argument("--results-dir", default="./results")
+    parser.add_argument("--calibration-size", type=int, default=200)
+    parser.add_argument(
+        "--max-accuracy-drop",
+        type=float,
+        default=1.0,
+        help="allowed top-1 accuracy drop in percentage points",
+    )
+    parser.add_argument("--per-tensor", action="store_true")
+    parser.add_argument("--providers", nargs="+", default=["CPUExecutionProvider"])
+    args = parser.parse_args()
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    summary = []
+    for model_name in args.model:
+        input_shape, input_mode = MODEL_CONFIG[model_name]
+        int8_path = quantize_model(
+            model_name,
+            args.model_dir,
+            args.image_dir,
+            args.calibration_size,
+            per_channel=not args.per_tensor,
+        )
+
+        for name, path in [
+            (model_name, os.path.join(args.model_dir, f"{model_name}.onnx")),
+            (f"{model_name}_int8", int8_path),
+        ]:
+            evaluate_model(
+                name,
+                load_model(path, args.providers),
+                args.image_dir,
+                input_shape,
+                input_mode,
+                results_dir=args.results_dir,
+            )
+
+        fp32_accuracy, fp32_latency = read_profile(
+            f"{args.results_dir}/{model_name}.csv"
+        )
+        int8_accuracy, int8_latency = read_profile(
+            f"{args.results_dir}/{model_name}_int8.csv"
+        )
+        accuracy_drop = fp32_accuracy - int8_accuracy
+        summary.append(
+            [
+                model_name,
+                round(fp32_accuracy, 2),
+                round(int8_accuracy, 2),
+                round(accuracy_drop, 2),
+                round(fp32_latency, 3),
+                round(int8_latency, 3),
+                round(fp32_latency / int8_latency, 2),
+                accuracy_drop <= args.max_accuracy_drop,
+            ]
+        )
+
+    header = [
+        "Model",
+        "FP32 Top-1 (%)",
+        "INT8 Top-1 (%)",
+        "Accuracy Drop (pp)",
+        "FP32 Latency (ms)",
+        "INT8 Latency (ms)",
+        "Speedup",
+        "Within Budget",
+    ]
+    with open(f"{args.results_dir}/quantization_summary.csv", "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(summary)
+    for row in summary:
+        print(dict(zip(header, row, strict=True)))
+
+    rejected = [row[0] for row in summary if not row[-1]]
+    if rejected:
+        print(
+            f"Accuracy drop above {args.max_accuracy_drop}pp for {rejected}, "
+            "do not deploy their int8 variant"
+        )
+        sys.exit(1)
@@ -0,0 +1,109 @@
+"""
+Probability-level ensemble aggregation.
+
+Every method takes the predictions as one `(n_models, n_classes)` float array,
+one probability vector per row, and returns a `(n_classes,)` score vector.
+No Python loop runs over the classes, aggregating a few models over the 1000
+ImageNet classes takes microseconds (see aggregation_benchmark.py).
+"""
+
+from collections.abc import Callable
+
+import numpy as np
+from numpy.typing import NDArray
+
+
+def average(probabilities: NDArray, weights: NDArray | None = None) -> NDArray:
+    return probabilities.mean(axis=0)
+
+
+def weighted_average(probabilities: NDArray, weights: NDArray | None = None) -> NDArray:
+    """Average with one weight per model, equal weights when None."""
+    if weights is None:
+        return average(probabilities)
+    weights = np.asarray(weights, dtype=probabilities.dtype)
+    if weights.shape != (probabilities.shape[0],):
+        raise ValueError(
+            f"Expected {probabilities.shape[0]} weights, got shape {weights.shape}"
+        )
+    return (weights / weights.sum()) @ probabilities
+
+
+def rank_average(probabilities: NDArray, weights: NDArray | None = None) -> NDArray:
+    """
+    Average of the per-model class ranks, scaled to [0, 1] (1 is the most
+    probable class of every model). Insensitive to differently calibrated models.
+    """
+    n_models, n_classes = probabilities.shape
+    order = np.argsort(probabilities, axis=1)
+    ordered = np.take_along_axis(probabilities, order, axis=1)
+    # Tied values share the rank of their first position, so the classes a
+    # top-k prediction doesn't carry (all 0) get rank 0 instead of arbitrary ones
+    positions = np.arange(n_classes, dtype=np.float32)
+    first_of_tie = np.ones(ordered.shape, dtype=bool)
+    np.not_equal(ordered[:, 1:], ordered[:, :-1], out=first_of_tie[:, 1:])
+    sorted_ranks = np.maximum.accumulate(np.where(first_of_tie, positions, 0), axis=1)
+    ranks = np.empty(probabilities.shape, dtype=np.float32)
+    # Scatter the positions instead of a second argsort
+    np.put_along_axis(ranks, order, sorted_ranks, axis=1)
+    return ranks.sum(axis=0) / (n_models * max(n_classes - 1, 1))
+
+
+def majority_vote(probabilities: NDArray, weights: NDArray | None = None) -> NDArray:
+    """
+    Share of the models voting for each class (their top-1). Ties are broken
+    by the average probability, which never outweighs a single vote.
+    """
+    n_models, n_classes = probabilities.shape
+    votes = np.bincount(probabilities.argmax(axis=1), minlength=n_classes)
+    return votes / n_models + average(probabilities) / (n_models + 1)
+
+
+def median(probabilities: NDArray, weights: NDArray | None = None) -> NDArray:
+    n_models = probabilities.shape[0]
+    # NOTE: np.median sorts along the short model axis, ~15x slower than the
+    # elementwise forms for the usual 2-3 model ensembles
+    if n_models <= 2:
+        return average(probabilities)
+    if n_models == 3:
+        first, second, third = probabilities
+        return np.maximum(
+            np.minimum(first, second),
+            np.minimum(np.maximum(first, second), third),
+        )
+    return np.median(probabilities, axis=0)
+
+
+AGGREGATORS: dict[str, Callable[..., NDArray]] = {
+    "average": average,
+    "weighted_average": weighted_average,
+    "rank_average": rank_average,
+    "majority_vote": majority_vote,
+    "median": median,
+}
+
+
+def top_k(scores: NDArray, k: int = 1) -> tuple[NDArray, NDArray]:
+    """Indices and scores of the k best classes, best first."""
+    k = min(k, scores.shape[-1])
+    indices = np.argpartition(scores, -k)[-k:]
+    indices = indices[np.argsort(-scores[indices])]
+    return indices, scores[indices]
+
+
+def aggregate(
+    probabilities: NDArray,
+    method: str = "average",
+    k: int = 1,
+    weights: NDArray | None = None,
+) -> tuple[NDArray, NDArray]:
+    """Top-k class indices and scores of the predictions aggregated by method."""
+    if method not in AGGREGATORS:
+        raise ValueError(
+            f"Unknown aggregation method {method}, expected one of {list(AGGREGATORS)}"
+        )
+    if probabilities.ndim != 2:
+        raise ValueError(
+            f"Expected a (n_models, n_classes) array, got shape {probabilities.shape}"
+        )
+    return top_k(AGGREGATORS[method](probabilities, weights), k)
@@ -0,0 +1,71 @@
+"""
+Microbenchmark of the ensemble aggregation functions.
+
+Times every method of aggregation.py (with the top-k selection) on full
+probability vectors, next to the dict based average_probability fed with
+one [class, probability] pair per class and model.
+
+    python aggregation_benchmark.py --models 2 3 5 --top-k 5
+"""
+
+import argparse
+import functools
+import timeit
+
+import aggregation
+import ensemble_function
+import numpy as np
+
+
+def random_probabilities(n_models: int, n_classes: int, seed: int = 0):
+    logits = np.random.default_rng(seed).normal(size=(n_models, n_classes))
+    probabilities = np.exp(logits)
+    return (probabilities / probabilities.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+def time_us(function, number: int) -> float:
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=int, nargs="+", default=[2, 3, 5])
+    parser.add_argument("--classes", type=int, default=1000)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'method':<28} " + " ".join(f"{n:>6} models" for n in args.models))
+    rows: dict[str, list[float]] = {}
+    for n_models in args.models:
+        probabilities = random_probabilities(n_models, args.classes)
+        weights = np.linspace(1, 2, n_models)
+        for method in aggregation.AGGREGATORS:
+            rows.setdefault(method, []).append(
+                time_us(
+                    functools.partial(
+                        aggregation.aggregate,
+                        probabilities,
+                        method,
+                        args.top_k,
+                        weights,
+                    ),
+                    args.number,
+                )
+            )
+
+        class_ids = ensemble_function.CLASS_IDS[: args.classes]
+        pairs = [
+            [class_id, float(probability)]
+            for row in probabilities
+            for class_id, probability in zip(class_ids, row, strict=True)
+        ]
+        rows.setdefault("average_probability (dict)", []).append(
+            time_us(
+                functools.partial(ensemble_function.average_probability, pairs, ""),
+                args.number // 20,
+            )
+        )
+
+    for method, timings in rows.items():
+        print(f"{method:<28} " + " ".join(f"{t:>10.1f}us" for t in timings))
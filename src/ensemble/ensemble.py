@@ -1,25 +1,103 @@
 from __future__ import annotations
 
 import asyncio
-import json
+import functools
 import logging
 import os
+import time
+from collections.abc import Callable
 from contextlib import asynccontextmanager
 from typing import Annotated
+from urllib.parse import urlsplit
 
+import aggregation
 import aio_pika
 import aiohttp
 import ensemble_function
-from fastapi import BackgroundTasks, FastAPI, Form, Request
+import numpy as np
+from fastapi import FastAPI, Form, Request
 from fastapi.responses import JSONResponse
-
-from util.utils import load_config, setup_otel
+from hedging import HedgeBudget, LatencyTracker
+from opentelemetry import metrics
+from replicas import Endpoint, ReplicaRouter, discover_dns, discover_file
+from result_publisher import ResultPublisher
+from work_queue import QueueFullError, WorkQueue
+
+from util.tensor_protocol import (
+    IMAGE_SIZES_HEADER,
+    INPUT_SIZES_HEADER,
+    MEDIA_TYPE,
+    TensorPrediction,
+    accept_header,
+    decode_prediction,
+    format_sizes,
+    negotiate,
+    parse_sizes,
+    split_batch,
+    split_images,
+)
+from util.utils import create_client_session, load_config, setup_otel
 
 SERVICE_NAME = os.environ.get("SERVICE_NAME", "ensemble")
 
+CLASS_INDEX = {class_id: i for i, class_id in enumerate(ensemble_function.CLASS_IDS)}
+
+# (height, width) input of each model, as in MODEL_CONFIG of the inference
+# service, `model_input_sizes` in the config overrides them (custom exports)
+MODEL_INPUT_SIZES = {
+    "DenseNet121": (224, 224),
+    "DenseNet201": (224, 224),
+    "EfficientNetB0": (224, 224),
+    "EfficientNetB7": (600, 600),
+    "EfficientNetV2L": (480, 480),
+    "EfficientNetV2S": (384, 384),
+    "InceptionResNetV2": (299, 299),
+    "InceptionV3": (299, 299),
+    "MobileNet": (224, 224),
+    "MobileNetV2": (224, 224),
+    "NASNetLarge": (331, 331),
+    "NASNetMobile": (224, 224),
+    "ResNet50": (224, 224),
+    "ResNet50V2": (224, 224),
+    "VGG16": (224, 224),
+    "Xception": (299, 299),
+}
+
 SEND_TO_QUEUE = os.environ.get("SEND_TO_QUEUE", "false").lower() == "true"
 
 setup_otel(SERVICE_NAME)
+meter = metrics.get_meter(SERVICE_NAME)
+contributing_models = meter.create_histogram(
+    "ensemble.aggregation.contributing_models",
+    description="Inference responses aggregated per image",
+)
+cancelled_requests = meter.create_counter(
+    "ensemble.inference.cancelled",
+    description="Inference requests cancelled once the quorum was reached",
+)
+inference_duration = meter.create_histogram(
+    "ensemble.inference.duration",
+    unit="s",
+    description="Latency of the successful inference requests per model",
+)
+hedged_requests = meter.create_counter(
+    "ensemble.hedging.requests",
+    description="Hedging decisions per model (sent, won, budget_exhausted)",
+)
+cascade_exits = meter.create_counter(
+    "ensemble.cascade.exits",
+    description="Images answered per cascade stage (the model that stopped it)",
+)
+
+speculative_latency = meter.create_histogram(
+    "ensemble.speculative.time_to_first_label",
+    unit="s",
+    description="Time from processing an image to its provisional result",
+)
+speculative_revisions = meter.create_counter(
+    "ensemble.speculative.revisions",
+    description="Refined results by whether they changed the provisional label",
+)
 
 config_lock = asyncio.Lock()  # Lock to control access to the global variable
 
@@ -30,6 +108,20 @@ config = load_config(file_path=config_file)
 assert config is not None
 logging.debug(f"Ensemble Service configuration: {config}")
 
+# NOTE: read at startup like the replicas section, the gRPC client is created
+# on the first request sent with protocol grpc
+transport_config = config.get("inference_transport", {})
+
+hedging_config = config.get("hedging", {})
+latency_tracker = LatencyTracker(
+    window=hedging_config.get("window", 256),
+    min_samples=hedging_config.get("min_samples", 32),
+)
+hedge_budget = HedgeBudget(
+    ratio=hedging_config.get("budget", 0.1),
+    burst=hedging_config.get("burst", 10),
+)
+
 
 def get_inference_service_url(ensemble_chosen: list[str]):
     return [f"http://{item.lower()}-service:5012/inference" for item in ensemble_chosen]
@@ -46,6 +138,11 @@ def get_inference_service_url_openziti(ensemble_chosen: list[str]):
     ]
 
 
+def get_inference_service_url_multi_model(ensemble_chosen: list[str], host_url: str):
+    # All models served by one inference process started with MULTI_MODEL
+    return [f"{host_url}/inference/{item}" for item in ensemble_chosen]
+
+
 def get_rabbitmq_connection_url():
     rabbitmq_url = os.environ.get("RABBITMQ_URL")
     username = os.environ.get("RABBITMQ_USERNAME")
@@ -55,31 +152,140 @@ def get_rabbitmq_connection_url():
     return f"amqp://{username}:{password}@{rabbitmq_url}"
 
 
-INFERENCE_SERVICE_URLS = get_inference_service_url(config["ensemble"])
-if os.environ.get("DOCKER"):
-    INFERENCE_SERVICE_URLS = get_inference_service_url_docker(config["ensemble"])
+MULTI_MODEL_INFERENCE_URL = os.environ.get("MULTI_MODEL_INFERENCE_URL")
+
 
-if os.environ.get("OPENZITI"):
-    INFERENCE_SERVICE_URLS = get_inference_service_url_openziti(config["ensemble"])
+def resolve_inference_service_urls(models: list[str]) -> list[str]:
+    """Inference URL of each model for the environment the service runs in."""
+    if MULTI_MODEL_INFERENCE_URL:
+        return get_inference_service_url_multi_model(models, MULTI_MODEL_INFERENCE_URL)
+    if os.environ.get("OPENZITI"):
+        return get_inference_service_url_openziti(models)
+    if os.environ.get("DOCKER"):
+        return get_inference_service_url_docker(models)
+    return get_inference_service_url(models)
+
+
+# NOTE: the replicas section is read at startup, /change_config only
+# refreshes the endpoints of the models it selects
+replicas_config = config.get("replicas", {})
+replica_router = ReplicaRouter(replicas_config.get("balancing", "p2c"))
+
+
+def inference_models(configuration: dict) -> list[str]:
+    """Models the configuration sends requests to, ensemble and cascade stages."""
+    stages = configuration.get("cascade", {}).get("stages", [])
+    return list(
+        dict.fromkeys([*configuration["ensemble"], *[s["model"] for s in stages]])
+    )
+
+
+async def discover_endpoints(model: str, service_url: str) -> list[str]:
+    """Endpoint URLs of model according to the `replicas.discovery` mode."""
+    discovery = replicas_config.get("discovery", "service")
+    if discovery == "file":
+        registry = discover_file(replicas_config["registry_file"])
+        return registry.get(model, [])
+    if discovery == "dns":
+        url = urlsplit(service_url)
+        host = replicas_config.get("dns_host", "{model}-headless")
+        return await discover_dns(
+            host.format(model=model.lower()),
+            replicas_config.get("port") or url.port or 80,
+            url.path,
+        )
+    return [service_url]
+
+
+async def resolve_replicas(configuration: dict) -> dict[str, list[str]]:
+    """Endpoint URLs of the models of configuration, without applying them."""
+    models = inference_models(configuration)
+    replicas = {}
+    for model, service_url in zip(
+        models, resolve_inference_service_urls(models), strict=True
+    ):
+        try:
+            urls = await discover_endpoints(model, service_url)
+        except Exception as e:
+            logging.warning(f"Endpoint discovery of {model} failed: {e}")
+            urls = []
+        # Keep the last known endpoints, the service URL when there are none
+        replicas[model] = (
+            urls or [e.url for e in replica_router.endpoints(model)] or [service_url]
+        )
+    return replicas
+
+
+def apply_replicas(replicas: dict[str, list[str]]):
+    for model, urls in replicas.items():
+        replica_router.set_endpoints(model, urls)
+
+
+async def refresh_replicas(configuration: dict):
+    apply_replicas(await resolve_replicas(configuration))
+
+
+async def refresh_replicas_periodically(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        await refresh_replicas(app.state.config)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # One pooled session for the whole app, connections to the inference
+    # services are kept alive across images
+    app.state.http_session = create_client_session(
+        SERVICE_NAME, config.get("http_client"), trust_env=True
+    )
+    app.state.grpc_client = None
+    await refresh_replicas(app.state.config)
+    refresh_task = None
+    if replicas_config.get("discovery", "service") != "service":
+        refresh_task = asyncio.create_task(
+            refresh_replicas_periodically(replicas_config.get("refresh_interval_s", 10))
+        )
+    try:
+        async with rabbitmq_lifespan(app):
+            # Bounded backlog processed by a fixed number of workers
+            app.state.work_queue = WorkQueue(**config.get("work_queue", {}))
+            await app.state.work_queue.start()
+            try:
+                yield
+            finally:
+                await app.state.work_queue.stop()
+    finally:
+        if refresh_task is not None:
+            refresh_task.cancel()
+        await app.state.http_session.close()
+        if app.state.grpc_client is not None:
+            await app.state.grpc_client.close()
+
+
+@asynccontextmanager
+async def rabbitmq_lifespan(app: FastAPI):
     if SEND_TO_QUEUE:
         rabbitmq_url = get_rabbitmq_connection_url()
         connection = await aio_pika.connect_robust(rabbitmq_url)
-        channel = await connection.channel()
+        channel = await connection.channel(publisher_confirms=True)
         queue_name = os.environ.get("RABBITMQ_QUEUE_NAME")
         if not queue_name:
             raise ValueError("RABBITMQ_QUEUE_NAME environment variable is not set")
         await channel.declare_queue(queue_name, durable=True)
 
+        publisher = ResultPublisher(
+            channel.default_exchange, queue_name, **config.get("result_publisher", {})
+        )
+        await publisher.start()
+
         app.state.rabbitmq_connection = connection
         app.state.rabbitmq_channel = channel
+        app.state.result_publisher = publisher
 
         yield  # Application runs during this period
 
-        # Close RabbitMQ connection and channel at shutdown
+        # Flush the buffered results, then close RabbitMQ connection and channel
+        await publisher.stop()
         await channel.close()
         await connection.close()
     else:
@@ -94,64 +300,542 @@ async def send_post_request(
     session: aiohttp.ClientSession, url: str, image_data: bytes, headers
 ):
     async with session.post(url, data=image_data, headers=headers) as response:
+        # An error answer (e.g. 404 for an unknown model) is a failed request,
+        # not a prediction
+        response.raise_for_status()
+        if response.content_type == MEDIA_TYPE:
+            return decode_prediction(await response.read())
         return await response.json()  # Assuming the response is JSON
 
 
-async def process_image_task(
-    image_data: bytes, request_id: str, headers, timestamp: str
+def get_grpc_client():
+    if app.state.grpc_client is None:
+        # NOTE: imported here so the REST-only deployments don't need grpcio
+        from grpc_transport import GrpcInferenceClient
+
+        app.state.grpc_client = GrpcInferenceClient(
+            port=transport_config.get("grpc_port", 5013),
+            channels_per_target=transport_config.get("channels_per_target", 1),
+            timeout=transport_config.get("timeout", 10),
+        )
+    return app.state.grpc_client
+
+
+async def send_inference_request(
+    session: aiohttp.ClientSession, model: str, url: str, image_data: bytes, headers
+):
+    if app.state.config.get("inference_transport", {}).get("protocol") != "grpc":
+        return await send_post_request(session, url, image_data, headers)
+    # gRPC always answers with a tensor, top-1 in float32 unless the
+    # inference_response options ask for more
+    options = negotiate(headers.get("accept")) or {"dtype": np.float32, "top_k": 1}
+    return await get_grpc_client().predict(url, model, image_data, **options)
+
+
+async def send_timed_request(
+    session: aiohttp.ClientSession,
+    model: str,
+    endpoint: Endpoint,
+    image_data: bytes,
+    headers,
+):
+    start = asyncio.get_running_loop().time()
+    with replica_router.track(endpoint):
+        result = await send_inference_request(
+            session, model, endpoint.url, image_data, headers
+        )
+    latency = asyncio.get_running_loop().time() - start
+    # NOTE: only completed requests are recorded, the ones cancelled by a
+    # hedge or the quorum slightly bias the percentiles low
+    latency_tracker.record(model, latency)
+    inference_duration.record(latency, {"model": model})
+    return result
+
+
+async def send_hedged_request(
+    session: aiohttp.ClientSession,
+    model: str,
+    image_data: bytes,
+    headers,
 ):
-    chosen_ensemble_function = getattr(
-        ensemble_function,
-        app.state.config["aggregating"]["aggregating_func"]["func_name"],
+    """
+    Send the inference request to a replica of model, and a duplicate to
+    another replica once it is slower than the `hedging.percentile` latency of
+    the model, the first answer wins.
+
+    With a single endpoint (the service URL) the duplicate goes to the same
+    URL, the service load balancing picks the replica.
+    """
+    endpoint = replica_router.choose(model)
+    primary = asyncio.create_task(
+        send_timed_request(session, model, endpoint, image_data, headers)
+    )
+    hedging = app.state.config.get("hedging", {})
+    hedge_budget.deposit()
+    delay = None
+    if hedging.get("enabled"):
+        delay = latency_tracker.percentile(model, hedging.get("percentile", 95))
+    if delay is None:
+        return await primary
+
+    tasks = {primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            return primary.result()
+        if not hedge_budget.try_spend():
+            hedged_requests.add(1, {"model": model, "outcome": "budget_exhausted"})
+            return await primary
+
+        hedged_requests.add(1, {"model": model, "outcome": "sent"})
+        hedge_endpoint = replica_router.choose(model, exclude=endpoint)
+        hedge = asyncio.create_task(
+            send_timed_request(session, model, hedge_endpoint, image_data, headers)
+        )
+        tasks.add(hedge)
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        hedged_requests.add(1, {"model": model, "outcome": "won"})
+                    return task.result()
+        # Both failed, report the original error
+        return primary.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# Describe the body received from preprocessing, not the frame forwarded
+NOT_FORWARDED_HEADERS = {"content-length", IMAGE_SIZES_HEADER.lower()}
+
+
+def get_inference_request_headers(headers) -> dict:
+    request_headers = {
+        key: value
+        for key, value in headers.items()
+        if key.lower() not in NOT_FORWARDED_HEADERS
+    }
+    response_config = app.state.config.get("inference_response", {})
+    if response_config.get("format") == "tensor":
+        request_headers["accept"] = accept_header(
+            dtype=response_config.get("dtype", "float16"),
+            top_k=response_config.get("top_k"),
+        )
+    return request_headers
+
+
+def model_input_size(model: str, configuration: dict) -> tuple[int, int]:
+    size = configuration.get("model_input_sizes", {}).get(model)
+    if size is not None:
+        return tuple(size)
+    return MODEL_INPUT_SIZES.get(model, (224, 224))
+
+
+def required_input_sizes(configuration: dict) -> list[tuple[int, int]]:
+    """Distinct input sizes of the models the configuration sends images to."""
+    return list(
+        dict.fromkeys(
+            model_input_size(model, configuration)
+            for model in inference_models(configuration)
+        )
     )
-    logging.debug(f"List service url: {INFERENCE_SERVICE_URLS}")
 
-    if not INFERENCE_SERVICE_URLS:
+
+def select_image(model: str, images: dict[tuple[int, int], bytes]) -> bytes:
+    """
+    Frame of the model's input size, else the smallest larger one (or the
+    largest), the inference service resizes it.
+    """
+    size = model_input_size(model, app.state.config)
+    if size in images:
+        return images[size]
+    larger = [s for s in images if s[0] >= size[0] and s[1] >= size[1]]
+    fallback = min(larger) if larger else max(images)
+    logging.debug(f"No {size} frame for {model}, sending {fallback}")
+    return images[fallback]
+
+
+def to_probability_vector(result) -> np.ndarray:
+    """Dense probability vector of a result, 0 for the classes it doesn't carry."""
+    if isinstance(result, TensorPrediction):
+        return result.probabilities(len(ensemble_function.CLASS_IDS))
+    class_id, probability = result
+    vector = np.zeros(len(ensemble_function.CLASS_IDS), dtype=np.float32)
+    vector[CLASS_INDEX[class_id]] = probability
+    return vector
+
+
+def to_class_probability(result) -> list:
+    # NOTE: the aggregating functions work on [class, probability] pairs
+    if isinstance(result, TensorPrediction):
+        return list(result.top1())
+    return result
+
+
+def parse_time_limit(time_limit) -> float | None:
+    """Seconds of a `time_limit` such as "3s", "500ms" or 3, None without limit."""
+    if time_limit is None:
+        return None
+    if isinstance(time_limit, int | float):
+        return float(time_limit)
+    value = str(time_limit).strip().lower()
+    for suffix, factor in (("ms", 0.001), ("s", 1.0), ("m", 60.0)):
+        if value.endswith(suffix):
+            return float(value[: -len(suffix)]) * factor
+    return float(value)
+
+
+async def gather_quorum(
+    tasks: dict[asyncio.Task, str],
+    quorum: int,
+    time_limit: float | None,
+    on_partial: Callable[[dict], None] | None = None,
+) -> dict:
+    """
+    Results by model of the first `quorum` successful requests, or of those
+    answered within `time_limit` seconds. Requests still running are cancelled.
+    on_partial gets the results so far whenever more are still awaited.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if time_limit is None else loop.time() + time_limit
+    results = {}
+    pending = set(tasks)
+    try:
+        while pending and len(results) < quorum:
+            timeout = None if deadline is None else deadline - loop.time()
+            if timeout is not None and timeout <= 0:
+                break
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                try:
+                    results[tasks[task]] = task.result()
+                except Exception as e:
+                    logging.warning(f"Inference request to {tasks[task]} failed: {e}")
+            if on_partial is not None and results and pending and len(results) < quorum:
+                on_partial(results)
+    finally:
+        for task in pending:
+            task.cancel()
+    if pending:
+        cancelled_requests.add(len(pending))
+        logging.debug(
+            f"Aggregating {list(results)}, cancelled {[tasks[t] for t in pending]}"
+        )
+    return results
+
+
+async def run_parallel(
+    images: dict[tuple[int, int], bytes],
+    request_headers: dict,
+    aggregating_config,
+    on_partial: Callable[[dict], None] | None = None,
+):
+    """Send the image to every model of the ensemble, results by model."""
+    models = app.state.config["ensemble"]
+    endpoints = {model: replica_router.endpoints(model) for model in models}
+    logging.debug(f"Inference endpoints: {endpoints}")
+    if not models:
         raise RuntimeError("No inference service url")
 
-    async with aiohttp.ClientSession(trust_env=True) as session:
-        tasks = [
-            asyncio.create_task(send_post_request(session, url, image_data, headers))
-            for url in INFERENCE_SERVICE_URLS
-        ]
-        done, _ = await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+    session = app.state.http_session
+    tasks = {
+        asyncio.create_task(
+            send_hedged_request(
+                session, model, select_image(model, images), request_headers
+            )
+        ): model
+        for model in models
+    }
+    # NOTE: aggregate as soon as min_message models answered or time_limit
+    # passed, a slow replica no longer delays every result
+    quorum = min(int(aggregating_config.get("min_message", len(tasks))), len(tasks))
+    return await gather_quorum(
+        tasks,
+        quorum,
+        parse_time_limit(aggregating_config.get("time_limit")),
+        on_partial,
+    )
+
 
-        results = []
-        for task in done:
-            results.append(await task)
+def confidence_margin(prediction: TensorPrediction) -> tuple[float, float]:
+    """Top-1 probability and its margin over the top-2 one."""
+    values = prediction.values.astype(np.float32)
+    if values.size < 2:
+        return float(values.max()), float(values.max())
+    second, first = np.partition(values, -2)[-2:]
+    return float(first), float(first - second)
 
-        # Run ensemble function on the results
-        final_result = chosen_ensemble_function(results, request_id)
-        final_result["Timestamp"] = timestamp
-        logging.debug(f"Ensembled result: {final_result}")
 
+def is_confident(prediction, stage: dict) -> bool:
+    if not isinstance(prediction, TensorPrediction):
+        # NOTE: a JSON answer only carries the top-1 class, no margin
+        confidence, margin = prediction[1], None
+    else:
+        confidence, margin = confidence_margin(prediction)
+    if confidence < stage.get("min_confidence", 0.0):
+        return False
+    if stage.get("min_margin") is not None:
+        return margin is not None and margin >= stage["min_margin"]
+    return True
+
+
+async def run_cascade(
+    images: dict[tuple[int, int], bytes],
+    request_headers: dict,
+    stages: list[dict],
+    on_partial: Callable[[dict], None] | None = None,
+):
+    """
+    Call the stage models in order, cheapest first. The next stage only runs
+    while the answers so far are below the stage's min_confidence or
+    min_margin (top-1 minus top-2 probability). Results by model, on_partial
+    gets the results so far before each further stage.
+    """
+    response_config = app.state.config.get("inference_response", {})
+    top_k = response_config.get("top_k")
+    # The margin needs at least the two most probable classes
+    cascade_headers = {
+        **request_headers,
+        "accept": accept_header(
+            dtype=response_config.get("dtype", "float16"),
+            top_k=None if top_k is None else max(2, top_k),
+        ),
+    }
+    session = app.state.http_session
+    results = {}
+    for i, stage in enumerate(stages):
+        model = stage["model"]
+        if i > 0 and results and on_partial is not None:
+            on_partial(results)
+        try:
+            results[model] = await send_hedged_request(
+                session, model, select_image(model, images), cascade_headers
+            )
+        except Exception as e:
+            logging.warning(f"Cascade stage {model} failed: {e}")
+            continue
+        if is_confident(results[model], stage):
+            break
+    if results:
+        cascade_exits.add(1, {"model": model})
+    return results
+
+
+def result_version() -> int:
+    """
+    Microseconds since the epoch, the `version` of a published result. The
+    refined result of an image is produced after its provisional one, so it
+    has the higher version, ml_consumer writes it as the row's write time.
+    """
+    return time.time_ns() // 1000
+
+
+class ProvisionalResult:
+    """
+    Speculative mode: publishes the top-1 of the first model to answer while
+    the rest of the ensemble is still awaited, the aggregated result later
+    replaces it (same request_id, higher version).
+    """
+
+    def __init__(self, request_id: str, timestamp: str):
+        self.request_id = request_id
+        self.timestamp = timestamp
+        self.result: dict | None = None
+        self._started = time.perf_counter()
+        self._publishing: asyncio.Task | None = None
+
+    def __call__(self, results: dict):
+        if self.result is not None:
+            return
+        model, first = next(iter(results.items()))
+        self.result = {
+            "request_id": self.request_id,
+            "prediction": [to_class_probability(first)],
+            "models": [model],
+            "version": result_version(),
+            "provisional": True,
+            "Timestamp": self.timestamp,
+        }
+        speculative_latency.record(time.perf_counter() - self._started)
+        logging.debug(f"Provisional result: {self.result}")
         if SEND_TO_QUEUE:
-            channel = app.state.rabbitmq_channel
-            queue_name = os.environ.get("RABBITMQ_QUEUE_NAME")
-            if not queue_name:
-                raise ValueError("RABBITMQ_QUEUE_NAME environment variable is not set")
-            message_body = json.dumps(final_result).encode()
-            message = aio_pika.Message(body=message_body)
-            await channel.default_exchange.publish(message, routing_key=queue_name)
-            logging.debug(f"Sent result to RabbitMQ queue {queue_name}")
+            self._publishing = asyncio.create_task(
+                app.state.result_publisher.publish(self.result)
+            )
 
+    async def refine(self, final_result: dict):
+        """Count whether final_result changed the label, once published."""
+        if self._publishing is not None:
+            # Queued first, consumers reading the queue in order see it first
+            await self._publishing
+        if self.result is not None:
+            changed = (
+                final_result["prediction"][0][0] != self.result["prediction"][0][0]
+            )
+            speculative_revisions.add(1, {"changed": changed})
 
-@app.post("/ensemble_service")
-async def ensemble(
-    request: Request,
-    background_tasks: BackgroundTasks,
+
+async def process_image_task(
+    images: dict[tuple[int, int], bytes], request_id: str, headers, timestamp: str
 ):
+    """Ensemble result of the frames of one image, by (height, width)."""
+    aggregating_config = app.state.config["aggregating"]["aggregating_func"]
+    func_name = aggregating_config["func_name"]
+    request_headers = get_inference_request_headers(headers)
+    cascade_config = app.state.config.get("cascade", {})
+    provisional = None
+    if app.state.config.get("speculative", {}).get("enabled"):
+        provisional = ProvisionalResult(request_id, timestamp)
+    if cascade_config.get("enabled"):
+        results = await run_cascade(
+            images, request_headers, cascade_config["stages"], provisional
+        )
+    else:
+        results = await run_parallel(
+            images, request_headers, aggregating_config, provisional
+        )
+    contributing_models.record(len(results))
+
+    if len(results) == 1:
+        # Cascade answered by its first stage, or a single model answered
+        # before the quorum or time limit: published as is, nothing to
+        # aggregate
+        final_result = {
+            "request_id": request_id,
+            "prediction": [to_class_probability(*results.values())],
+        }
+    elif func_name in aggregation.AGGREGATORS:
+        # Vectorized aggregation of the (n_models, n_classes) probabilities
+        weights = aggregating_config.get("weights")
+        final_result = ensemble_function.aggregate_probabilities(
+            np.stack([to_probability_vector(result) for result in results.values()])
+            if results
+            else np.empty((0, len(CLASS_INDEX)), dtype=np.float32),
+            request_id,
+            method=func_name,
+            top_k=int(aggregating_config.get("top_k", 1)),
+            weights=None
+            if weights is None
+            else [float(weights.get(model, 1.0)) for model in results],
+        )
+    else:
+        # Run ensemble function on the results
+        chosen_ensemble_function = getattr(ensemble_function, func_name)
+        final_result = chosen_ensemble_function(
+            [to_class_probability(result) for result in results.values()],
+            request_id,
+        )
+    if final_result is None:
+        # NOTE: a provisional result already published stays the answer
+        logging.warning(f"Request {request_id} dropped, no model answered (in time)")
+        return
+    final_result["models"] = list(results)
+    final_result["version"] = result_version()
+    final_result["provisional"] = False
+    final_result["Timestamp"] = timestamp
+    logging.debug(f"Ensembled result: {final_result}")
+    if provisional is not None:
+        await provisional.refine(final_result)
+
+    if SEND_TO_QUEUE:
+        # Buffered and published in batches, waits while the broker lags behind
+        await app.state.result_publisher.publish(final_result)
+
+
+def input_sizes_headers() -> dict:
+    # Frame sizes wanted for the next images, for the current models
+    return {INPUT_SIZES_HEADER: format_sizes(required_input_sizes(app.state.config))}
+
+
+@app.post("/ensemble_service")
+async def ensemble(request: Request):
     try:
         image_bytes = await request.body()
         request_id = request.query_params["request_id"]
         headers = request.headers
         # logging.info(image_bytes)
-        background_tasks.add_task(
-            process_image_task, image_bytes, request_id, headers, headers["Timestamp"]
+        try:
+            # One frame per model input size, see preprocessing output_sizes
+            images = split_images(
+                image_bytes, parse_sizes(headers.get(IMAGE_SIZES_HEADER))
+            )
+        except ValueError as e:
+            return JSONResponse(content={"error": str(e)}, status_code=400)
+        app.state.work_queue.submit(
+            functools.partial(
+                process_image_task,
+                images,
+                request_id,
+                headers,
+                headers["Timestamp"],
+            )
         )
 
         response = "Success to add image to Ensemble Service"
-        return JSONResponse(content={"response": response}, status_code=200)
+        return JSONResponse(
+            content={"response": response},
+            status_code=200,
+            headers=input_sizes_headers(),
+        )
+    except QueueFullError as e:
+        # NOTE: shed load instead of growing an unbounded backlog
+        return JSONResponse(
+            content={"error": str(e)},
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except Exception as e:
+        logging.exception(f"Error: {e}")
+        return JSONResponse(content={"error": f"Error: {e}"}, status_code=500)
+
+
+@app.post("/ensemble_service/batch")
+async def ensemble_batch(request: Request):
+    """
+    Images of a preprocessing batch upload: their frames back to back in the
+    body, one request_id query parameter per image, in the same order.
+    """
+    try:
+        body = await request.body()
+        request_ids = request.query_params.getlist("request_id")
+        headers = request.headers
+        try:
+            batch = split_batch(
+                body, parse_sizes(headers.get(IMAGE_SIZES_HEADER)), len(request_ids)
+            )
+        except ValueError as e:
+            return JSONResponse(content={"error": str(e)}, status_code=400)
+        # NOTE: queued together, their inference requests reach the dynamic
+        # batchers of the inference services at the same time
+        app.state.work_queue.submit_many(
+            [
+                functools.partial(
+                    process_image_task,
+                    images,
+                    request_id,
+                    headers,
+                    headers["Timestamp"],
+                )
+                for images, request_id in zip(batch, request_ids, strict=False)
+            ]
+        )
+
+        response = f"Success to add {len(batch)} images to Ensemble Service"
+        return JSONResponse(
+            content={"response": response},
+            status_code=200,
+            headers=input_sizes_headers(),
+        )
+    except QueueFullError as e:
+        return JSONResponse(
+            content={"error": str(e)},
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)},
+        )
     except Exception as e:
         logging.exception(f"Error: {e}")
         return JSONResponse(content={"error": f"Error: {e}"}, status_code=500)
@@ -161,11 +845,12 @@ async def ensemble(
 async def change_requirement(configuration: Annotated[dict, Form()]):
     try:
         async with config_lock:
+            # NOTE: requests in flight don't take the lock, the new models get
+            # their endpoints in the same step as the config, with no await
+            # in between
+            replicas = await resolve_replicas(configuration)
+            apply_replicas(replicas)
             app.state.config = configuration
-            global INFERENCE_SERVICE_URLS
-            INFERENCE_SERVICE_URLS = get_inference_service_url(
-                app.state.config["ensemble"]
-            )
             response = f"Change ensemble to: {configuration} successfully"
             return JSONResponse(content={"response": response}, status_code=200)
     except Exception as e:
@@ -0,0 +1,98 @@
+"""
+gRPC client of the inference services (inference_transport.protocol: grpc).
+
+Requests and replies are the util.tensor_protocol payloads, see
+inference/grpc_server.py. One channel, i.e. one HTTP/2 connection, is kept per
+inference host and the concurrent requests to it are multiplexed as streams,
+`channels_per_target` > 1 spreads them over a few connections.
+"""
+
+import itertools
+from urllib.parse import urlsplit
+
+import grpc
+import numpy as np
+
+from util.tensor_protocol import (
+    GRPC_PREDICT_METHOD,
+    TensorPrediction,
+    decode_prediction,
+    encode_request,
+    square_size,
+)
+
+# 8MB, room for the largest model inputs (600x600x3)
+MAX_MESSAGE_LENGTH = 8 * 1024 * 1024
+
+
+class GrpcInferenceClient:
+    def __init__(
+        self,
+        port: int = 5013,
+        channels_per_target: int = 1,
+        timeout: float | None = 10,
+    ):
+        self.port = port
+        self.channels_per_target = channels_per_target
+        self.timeout = timeout
+        self._channels: dict[str, list[grpc.aio.Channel]] = {}
+        self._round_robin: dict[str, itertools.cycle] = {}
+
+    def target(self, url: str) -> str:
+        """host:port of the gRPC server next to the REST endpoint url."""
+        host = urlsplit(url).hostname
+        if host is None:
+            raise ValueError(f"No host in inference URL {url}")
+        return f"[{host}]:{self.port}" if ":" in host else f"{host}:{self.port}"
+
+    def _predict_method(self, target: str) -> grpc.aio.UnaryUnaryMultiCallable:
+        if target not in self._channels:
+            options = [
+                ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+                ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+                ("grpc.keepalive_time_ms", 30000),
+                # Separate connections for the channels of one target
+                ("grpc.use_local_subchannel_pool", 1),
+            ]
+            self._channels[target] = [
+                grpc.aio.insecure_channel(target, options=options)
+                for _ in range(self.channels_per_target)
+            ]
+            self._round_robin[target] = itertools.cycle(
+                [
+                    channel.unary_unary(
+                        GRPC_PREDICT_METHOD, response_deserializer=decode_prediction
+                    )
+                    for channel in self._channels[target]
+                ]
+            )
+        return next(self._round_robin[target])
+
+    async def predict(
+        self,
+        url: str,
+        model: str,
+        image_data: bytes,
+        shape: tuple[int, ...] | None = None,
+        top_k: int | None = 1,
+        dtype: type = np.float32,
+    ) -> TensorPrediction:
+        """
+        Prediction of model for the raw uint8 image, from the host of url.
+        Without shape the image is a square RGB frame.
+        """
+        if shape is None:
+            shape = (*square_size(len(image_data)), 3)
+        payload = encode_request(
+            model, image_data, shape=shape, top_k=top_k, dtype=dtype
+        )
+        return await self._predict_method(self.target(url))(
+            payload, timeout=self.timeout
+        )
+
+    async def close(self):
+        for channels in self._channels.values():
+            for channel in channels:
+                await channel.close()
+        self._channels.clear()
+        self._round_robin.clear()
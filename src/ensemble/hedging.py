@@ -0,0 +1,46 @@
+"""
+Bookkeeping of hedged inference requests.
+
+A request slower than a percentile of the recent latencies of its model gets
+a duplicate sent to another replica, the first answer wins. The budget caps
+the extra load: every request earns `ratio` of a hedge, so at most about
+`ratio` extra requests are sent per request, with bursts of `burst` hedges.
+"""
+
+from collections import defaultdict, deque
+
+import numpy as np
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 256, min_samples: int = 32):
+        self.min_samples = min_samples
+        self._latencies: defaultdict[str, deque[float]] = defaultdict(
+            lambda: deque(maxlen=window)
+        )
+
+    def record(self, model: str, latency: float):
+        self._latencies[model].append(latency)
+
+    def percentile(self, model: str, percentile: float) -> float | None:
+        """Latency percentile of model in seconds, None until min_samples."""
+        latencies = self._latencies[model]
+        if len(latencies) < self.min_samples:
+            return None
+        return float(np.percentile(latencies, percentile))
+
+
+class HedgeBudget:
+    def __init__(self, ratio: float = 0.1, burst: float = 10):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = burst
+
+    def deposit(self):
+        self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
@@ -0,0 +1,108 @@
+"""
+Replica-aware routing of the inference requests.
+
+The endpoints of each model come from one of:
+- service: the single service URL, kube-proxy spreads the requests
+- dns: the A records of a headless service, one endpoint per pod
+- file: a registry file mapping each model to its endpoint URLs
+
+Each request goes to the endpoint with the fewest outstanding requests among
+two random ones (power of two choices, `p2c`) or among all of them
+(`least_outstanding`), so busy or throttled replicas get less traffic.
+"""
+
+import asyncio
+import logging
+import random
+import socket
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from opentelemetry import metrics
+
+from util.utils import load_config
+
+meter = metrics.get_meter(__name__)
+
+BALANCING_STRATEGIES = ("p2c", "least_outstanding")
+
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+
+    def __repr__(self):
+        return f"Endpoint({self.url}, outstanding={self.outstanding})"
+
+
+class ReplicaRouter:
+    def __init__(self, balancing: str = "p2c"):
+        if balancing not in BALANCING_STRATEGIES:
+            raise ValueError(
+                f"Unknown balancing {balancing}, expected one of {BALANCING_STRATEGIES}"
+            )
+        self.balancing = balancing
+        self._endpoints: dict[str, list[Endpoint]] = {}
+
+        meter.create_observable_gauge(
+            "ensemble.replicas.outstanding",
+            callbacks=[self._observe_outstanding],
+            description="Requests in flight per inference endpoint",
+        )
+
+    def set_endpoints(self, model: str, urls: list[str]):
+        """Replace the endpoints of model, known ones keep their counters."""
+        known = {endpoint.url: endpoint for endpoint in self._endpoints.get(model, [])}
+        endpoints = [known.get(url) or Endpoint(url) for url in dict.fromkeys(urls)]
+        if [e.url for e in endpoints] != list(known):
+            logging.info(f"Endpoints of {model}: {[e.url for e in endpoints]}")
+        self._endpoints[model] = endpoints
+
+    def endpoints(self, model: str) -> list[Endpoint]:
+        return self._endpoints.get(model, [])
+
+    def choose(self, model: str, exclude: Endpoint | None = None) -> Endpoint:
+        """Endpoint for the next request to model, another one than exclude if any."""
+        endpoints = self.endpoints(model)
+        if not endpoints:
+            raise RuntimeError(f"No inference endpoint for {model}")
+        candidates = [e for e in endpoints if e is not exclude] or endpoints
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.balancing == "p2c":
+            first, second = random.sample(candidates, 2)
+            return first if first.outstanding <= second.outstanding else second
+        fewest = min(endpoint.outstanding for endpoint in candidates)
+        return random.choice([e for e in candidates if e.outstanding == fewest])
+
+    @contextmanager
+    def track(self, endpoint: Endpoint) -> Iterator[Endpoint]:
+        endpoint.outstanding += 1
+        try:
+            yield endpoint
+        finally:
+            endpoint.outstanding -= 1
+
+    def _observe_outstanding(self, options):
+        for model, endpoints in self._endpoints.items():
+            for endpoint in endpoints:
+                yield metrics.Observation(
+                    endpoint.outstanding, {"model": model, "endpoint": endpoint.url}
+                )
+
+
+async def discover_dns(host: str, port: int, path: str) -> list[str]:
+    """One URL per A record of host, e.g. the pods behind a headless service."""
+    loop = asyncio.get_running_loop()
+    addresses = await loop.getaddrinfo(
+        host, port, family=socket.AF_INET, type=socket.SOCK_STREAM
+    )
+    ips = sorted({address[4][0] for address in addresses})
+    return [f"http://{ip}:{port}{path}" for ip in ips]
+
+
+def discover_file(registry_file: str) -> dict[str, list[str]]:
+    """Endpoint URLs by model from a YAML registry file."""
+    registry = load_config(file_path=registry_file) or {}
+    return {model: list(urls or []) for model, urls in registry.items()}
@@ -0,0 +1,176 @@
+"""
+Batched RabbitMQ publishing of the ensembled results.
+
+Results are buffered and flushed as one message (a JSON array) when
+`max_batch_size` results are waiting or `flush_interval_ms` after the first
+one. Batches are published with publisher confirms, at most `max_outstanding`
+batches wait for their confirm. Once `max_buffered` results are waiting,
+publish() blocks, slowing the ensemble down to the pace of the broker.
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+import aio_pika
+from opentelemetry import metrics
+
+meter = metrics.get_meter(__name__)
+
+# Put in the buffer by stop(), the worker sends its batch and returns on it
+_STOP = object()
+
+
+class ResultPublisher:
+    def __init__(
+        self,
+        exchange: aio_pika.abc.AbstractExchange,
+        routing_key: str,
+        max_batch_size: int = 64,
+        flush_interval_ms: float = 50,
+        max_outstanding: int = 8,
+        max_buffered: int = 1024,
+        max_retries: int = 3,
+    ):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_retries = max_retries
+        self._buffer: asyncio.Queue[dict] = asyncio.Queue(maxsize=max_buffered)
+        self._window = asyncio.Semaphore(max_outstanding)
+        self._outstanding: set[asyncio.Task] = set()
+        self._worker: asyncio.Task | None = None
+
+        self._published = meter.create_counter(
+            "ensemble.publisher.results",
+            description="Results published by outcome (confirmed, failed)",
+        )
+        self._publish_duration = meter.create_histogram(
+            "ensemble.publisher.publish_duration",
+            unit="s",
+            description="Time from publishing a batch to its broker confirm",
+        )
+        self._batch_size = meter.create_histogram(
+            "ensemble.publisher.batch_size", description="Results per message"
+        )
+        self._blocked = meter.create_counter(
+            "ensemble.publisher.blocked",
+            description="publish() calls that waited for buffer space",
+        )
+        meter.create_observable_gauge(
+            "ensemble.publisher.buffered",
+            callbacks=[lambda options: [metrics.Observation(self._buffer.qsize())]],
+            description="Results waiting to be published",
+        )
+        meter.create_observable_gauge(
+            "ensemble.publisher.outstanding",
+            callbacks=[lambda options: [metrics.Observation(len(self._outstanding))]],
+            description="Batches waiting for their broker confirm",
+        )
+
+    async def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush the buffered results and wait for the outstanding confirms."""
+        if self._worker is None:
+            return
+        # NOTE: not cancelled, the worker holds the results of the batch it is
+        # collecting
+        await self._buffer.put(_STOP)
+        await self._worker
+        self._worker = None
+        # Results published while stopping
+        while not self._buffer.empty():
+            batch = [
+                self._buffer.get_nowait()
+                for _ in range(min(self.max_batch_size, self._buffer.qsize()))
+            ]
+            await self._window.acquire()
+            self._send(batch)
+        if self._outstanding:
+            await asyncio.wait(self._outstanding)
+
+    async def publish(self, result: dict):
+        """Queue a result, waits while the buffer is full (backpressure)."""
+        if self._buffer.full():
+            self._blocked.add(1)
+        await self._buffer.put(result)
+
+    async def _collect_batch(self) -> tuple[list[dict], bool]:
+        """The next batch, and whether stop() was called meanwhile."""
+        item = await self._buffer.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.max_batch_size:
+            if not self._buffer.empty():
+                item = self._buffer.get_nowait()
+            else:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._buffer.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self):
+        while True:
+            # Wait for a confirm slot first so the results keep accumulating
+            # into the next batch while the broker is slow
+            await self._window.acquire()
+            try:
+                batch, stopping = await self._collect_batch()
+            except asyncio.CancelledError:
+                self._window.release()
+                raise
+            if batch:
+                self._send(batch)
+            else:
+                self._window.release()
+            if stopping:
+                return
+
+    def _send(self, batch: list[dict]):
+        task = asyncio.create_task(self._publish_batch(batch))
+        self._outstanding.add(task)
+        task.add_done_callback(self._outstanding.discard)
+
+    async def _publish_batch(self, batch: list[dict]):
+        message = aio_pika.Message(
+            body=json.dumps(batch).encode(),
+            content_type="application/json",
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            headers={"x-batch-size": len(batch)},
+        )
+        try:
+            for attempt in range(self.max_retries + 1):
+                start = time.perf_counter()
+                try:
+                    # Returns once the broker confirmed the message
+                    await self.exchange.publish(message, routing_key=self.routing_key)
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        logging.error(f"Dropped {len(batch)} results: {e}")
+                        self._published.add(len(batch), {"outcome": "failed"})
+                        return
+                    logging.warning(f"Publishing {len(batch)} results failed: {e}")
+                    await asyncio.sleep(0.1 * 2**attempt)
+                    continue
+                self._publish_duration.record(time.perf_counter() - start)
+                self._batch_size.record(len(batch))
+                self._published.add(len(batch), {"outcome": "confirmed"})
+                logging.debug(f"Published {len(batch)} results to {self.routing_key}")
+                return
+        finally:
+            self._window.release()
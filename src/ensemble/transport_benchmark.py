@@ -0,0 +1,110 @@
+"""
+REST vs gRPC benchmark of the ensemble -> inference hop.
+
+Sends random 224x224x3 images to a running inference service with
+`concurrency` requests in flight, over the pooled aiohttp session of the
+ensemble (JSON and tensor answers) and over the gRPC transport, and prints the
+throughput and latency percentiles of each. The inference service needs
+grpc.enabled in its configuration.
+
+    python transport_benchmark.py --url http://localhost:5012/inference \\
+        --model MobileNetV2 --grpc-port 5013 --requests 2000 --concurrency 64
+"""
+
+import argparse
+import asyncio
+import time
+from collections.abc import Awaitable, Callable
+
+import numpy as np
+from grpc_transport import GrpcInferenceClient
+
+from util.tensor_protocol import accept_header, decode_prediction
+from util.utils import create_client_session
+
+
+async def run(
+    send: Callable[[bytes], Awaitable], images: list[bytes], concurrency: int
+) -> tuple[float, np.ndarray]:
+    """Wall time and per-request latencies (s) of sending every image."""
+    latencies = np.empty(len(images))
+    next_image = iter(range(len(images)))
+
+    async def worker():
+        for i in next_image:
+            start = time.perf_counter()
+            await send(images[i])
+            latencies[i] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return time.perf_counter() - start, latencies
+
+
+async def main(args):
+    rng = np.random.default_rng(0)
+    # A few distinct frames, repeated, so the prediction cache of the
+    # inference service answers the same share over every transport
+    frames = [
+        rng.integers(0, 256, (224, 224, 3), dtype=np.uint8).tobytes()
+        for _ in range(args.distinct_images)
+    ]
+    images = [frames[i % len(frames)] for i in range(args.requests)]
+
+    session = create_client_session(
+        "transport-benchmark", {"limit": 0, "limit_per_host": args.concurrency}
+    )
+    grpc_client = GrpcInferenceClient(
+        port=args.grpc_port, channels_per_target=args.channels_per_target
+    )
+    tensor_accept = accept_header(dtype="float32", top_k=args.top_k)
+
+    async def rest_json(image: bytes):
+        async with session.post(args.url, data=image) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def rest_tensor(image: bytes):
+        async with session.post(
+            args.url, data=image, headers={"accept": tensor_accept}
+        ) as response:
+            response.raise_for_status()
+            return decode_prediction(await response.read())
+
+    async def grpc_tensor(image: bytes):
+        return await grpc_client.predict(
+            args.url, args.model, image, top_k=args.top_k, dtype=np.float32
+        )
+
+    transports = {
+        "rest json": rest_json,
+        "rest tensor": rest_tensor,
+        "grpc tensor": grpc_tensor,
+    }
+    print(
+        f"{args.requests} requests, concurrency {args.concurrency}, top_k {args.top_k}"
+    )
+    print(f"{'transport':<12} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    try:
+        for name, send in transports.items():
+            # Warm up the connections and the model
+            await run(send, images[: args.concurrency], args.concurrency)
+            duration, latencies = await run(send, images, args.concurrency)
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+            print(f"{name:<12} {len(images) / duration:>8.1f} {p50:>8.2f} {p99:>8.2f}")
+    finally:
+        await session.close()
+        await grpc_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5012/inference")
+    parser.add_argument("--model", default="MobileNetV2")
+    parser.add_argument("--grpc-port", type=int, default=5013)
+    parser.add_argument("--channels-per-target", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--distinct-images", type=int, default=2000)
+    parser.add_argument("--top-k", type=int, default=5)
+    asyncio.run(main(args=parser.parse_args()))
@@ -0,0 +1,104 @@
+"""
+Bounded work queue of the ensemble service.
+
+A fixed number of worker coroutines process the queued images. When
+`max_size` images are waiting, submit() refuses new ones instead of letting
+the backlog (and the memory of the pod) grow without bound. submit_many()
+queues the images of a batch together, or refuses them all.
+"""
+
+import asyncio
+import logging
+import math
+import time
+from collections.abc import Awaitable, Callable
+
+from opentelemetry import metrics
+
+meter = metrics.get_meter(__name__)
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Work queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class WorkQueue:
+    def __init__(self, max_size: int = 256, workers: int = 32):
+        self.max_size = max_size
+        self.num_workers = workers
+        self._queue: asyncio.Queue[tuple[float, Callable[[], Awaitable]]] = (
+            asyncio.Queue(maxsize=max_size)
+        )
+        self._workers: list[asyncio.Task] = []
+        # Moving average of the processing time, for the Retry-After estimate
+        self._average_duration = 0.1
+
+        self._wait_time = meter.create_histogram(
+            "ensemble.work_queue.wait_time",
+            unit="s",
+            description="Time an image waited in the queue before processing",
+        )
+        self._rejections = meter.create_counter(
+            "ensemble.work_queue.rejections",
+            description="Images rejected with 429 because the queue was full",
+        )
+        meter.create_observable_gauge(
+            "ensemble.work_queue.depth",
+            callbacks=[lambda options: [metrics.Observation(self._queue.qsize())]],
+            description="Images waiting in the queue",
+        )
+
+    async def start(self):
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._work()) for _ in range(self.num_workers)
+            ]
+
+    async def stop(self, drain_timeout: float = 10):
+        """Let the workers finish the queued images, then cancel them."""
+        try:
+            await asyncio.wait_for(self._queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Dropping {self._queue.qsize()} queued images")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, job: Callable[[], Awaitable]):
+        """Queue job, raises QueueFullError when max_size jobs are waiting."""
+        try:
+            self._queue.put_nowait((time.perf_counter(), job))
+        except asyncio.QueueFull:
+            self._rejections.add(1)
+            raise QueueFullError(self.retry_after()) from None
+
+    def submit_many(self, jobs: list[Callable[[], Awaitable]]):
+        """Queue all of jobs (a batch), or none of them with QueueFullError."""
+        if self._queue.maxsize - self._queue.qsize() < len(jobs):
+            self._rejections.add(len(jobs))
+            raise QueueFullError(self.retry_after())
+        queued_at = time.perf_counter()
+        for job in jobs:
+            self._queue.put_nowait((queued_at, job))
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog is processed, at least 1."""
+        backlog = self._queue.qsize() * self._average_duration / self.num_workers
+        return max(1, math.ceil(backlog))
+
+    async def _work(self):
+        while True:
+            queued_at, job = await self._queue.get()
+            start = time.perf_counter()
+            self._wait_time.record(start - queued_at)
+            try:
+                await job()
+            except Exception as e:
+                logging.exception(f"Error: {e}")
+            finally:
+                duration = time.perf_counter() - start
+                self._average_duration += 0.1 * (duration - self._average_duration)
+                self._queue.task_done()
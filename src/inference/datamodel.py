@@ -25,6 +25,62 @@ class ImageClassificationModelEnum(Enum):
 class ModelConfig(BaseModel):
     input_shape: tuple[int, int, int, int]
     input_mode: str
+    # Load ./onnx_model/{model}_{model_variant}.onnx instead of the plain export,
+    # e.g. "uint8" for models with the input normalization fused into the graph
+    # or "int8" for the statically quantized models
+    model_variant: str | None = None
+
+
+class BatchingConfig(BaseModel):
+    enabled: bool = True
+    # Upper bound on the number of requests fused into one session.run
+    max_batch_size: int = 16
+    # How long the first request of a batch waits for others to join
+    max_wait_ms: float = 5.0
+
+
+class RuntimeConfig(BaseModel):
+    # Threads ONNX Runtime uses inside a single session.run, 0 splits the
+    # available cores evenly across the executor workers
+    intra_op_num_threads: int = 0
+    inter_op_num_threads: int = 1
+    # Worker threads that run session.run off the asyncio event loop
+    executor_workers: int = 1
+    # Maximum session.run calls in flight, the rest wait on the event loop
+    # (and keep collecting requests in the batchers). None: executor_workers,
+    # more only queue batches in the executor
+    max_concurrency: int | None = None
+
+
+class ModelCacheConfig(BaseModel):
+    # Load pre-optimized ORT format models instead of optimizing at startup
+    enabled: bool = True
+    directory: str = "./onnx_model_cache"
+
+
+class PredictionCacheConfig(BaseModel):
+    # Reuse the prediction of identical input frames
+    enabled: bool = True
+    # An entry holds one probability vector, ~4KB for the 1000 ImageNet classes
+    max_entries: int = 4096
+    max_memory_mb: float = 32
+    ttl_s: float = 60
+
+
+class WarmupConfig(BaseModel):
+    # Run synthetic batches before /ready reports the pod ready
+    enabled: bool = True
+    # Batch sizes to warm up, empty uses 1 and batching.max_batch_size
+    batch_sizes: list[int] = []
+    iterations: int = 3
+
+
+class GrpcConfig(BaseModel):
+    # Serve the tensor protocol over gRPC next to the REST endpoint
+    enabled: bool = False
+    port: int = 5013
+    # Calls beyond this are rejected with RESOURCE_EXHAUSTED, None is unbounded
+    max_concurrent_rpcs: int | None = None
 
 
 class InferenceServiceConfig(BaseModel):
@@ -32,3 +88,11 @@ class InferenceServiceConfig(BaseModel):
     ensemble: bool
     model_config_dict: dict[ImageClassificationModelEnum, ModelConfig]
     external_services: dict
+    batching: BatchingConfig = BatchingConfig()
+    runtime: RuntimeConfig = RuntimeConfig()
+    model_cache: ModelCacheConfig = ModelCacheConfig()
+    prediction_cache: PredictionCacheConfig = PredictionCacheConfig()
+    warmup: WarmupConfig = WarmupConfig()
+    grpc: GrpcConfig = GrpcConfig()
+    # Models served by a single process started with MULTI_MODEL=true
+    hosted_models: list[ImageClassificationModelEnum] = []
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+from collections.abc import Callable
+from concurrent.futures import Executor
+from typing import Any
+
+from numpy._typing import NDArray
+
+
+class DynamicBatcher:
+    """
+    Collects concurrent inference requests into a single batch.
+
+    The first request of a batch waits at most `max_wait_ms` for other requests
+    to join, the batch is cut as soon as it reaches `max_batch_size`. Each caller
+    receives the result belonging to its own input.
+
+    Batches run on `executor` so the event loop stays responsive. At most
+    `max_concurrency` batches are in flight, while all slots are busy new
+    requests keep accumulating into the next batch. Batchers of different
+    models can share their in-flight budget by passing the same `slots`.
+    """
+
+    def __init__(
+        self,
+        predict_batch: Callable[[list[NDArray]], list[Any]],
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+        executor: Executor | None = None,
+        max_concurrency: int = 1,
+        slots: asyncio.Semaphore | None = None,
+    ):
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be >= 1, got {max_batch_size}")
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self._slots = slots or asyncio.Semaphore(max_concurrency)
+        self._queue: asyncio.Queue[tuple[NDArray, asyncio.Future]] = asyncio.Queue()
+        self._worker: asyncio.Task | None = None
+        self._in_flight: set[asyncio.Task] = set()
+        # Requests taken off the queue for the batch being collected
+        self._collecting: list[tuple[NDArray, asyncio.Future]] = []
+
+    async def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        if self._in_flight:
+            await asyncio.wait(self._in_flight)
+
+        # Submitted while the last batches finished
+        self._fail_waiting()
+
+    def _fail_waiting(self):
+        """Fail the requests not sent to a batch instead of leaving the callers hanging."""
+        waiting, self._collecting = self._collecting, []
+        while not self._queue.empty():
+            waiting.append(self._queue.get_nowait())
+        for _, future in waiting:
+            if not future.done():
+                future.set_exception(RuntimeError("Batcher stopped"))
+
+    async def submit(self, image_array: NDArray):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image_array, future))
+        return await future
+
+    async def _collect_batch(self) -> list[tuple[NDArray, asyncio.Future]]:
+        batch = self._collecting = []
+        batch.append(await self._queue.get())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            # Take everything that is already waiting before sleeping on the queue
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _execute(self, batch: list[tuple[NDArray, asyncio.Future]]):
+        try:
+            loop = asyncio.get_running_loop()
+            results = await loop.run_in_executor(
+                self.executor, self.predict_batch, [image for image, _ in batch]
+            )
+        except Exception as e:
+            logging.exception(f"Batch inference failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+
+        logging.debug(f"Ran inference batch of size {len(batch)}")
+        for (_, future), result in zip(batch, results, strict=True):
+            if not future.done():
+                future.set_result(result)
+
+    async def _run(self):
+        while True:
+            await self._slots.acquire()
+            try:
+                batch = await self._collect_batch()
+            except asyncio.CancelledError:
+                # stop(): the requests of the partly collected batch were
+                # already taken off the queue
+                self._slots.release()
+                self._fail_waiting()
+                raise
+            self._collecting = []
+            # Requests whose caller went away don't need to be computed
+            batch = [(image, future) for image, future in batch if not future.done()]
+            if not batch:
+                self._slots.release()
+                continue
+
+            task = asyncio.create_task(self._execute(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
@@ -0,0 +1,65 @@
+"""
+gRPC transport of the inference service.
+
+Serves GRPC_PREDICT_METHOD next to the REST endpoint. Requests and replies are
+the util.tensor_protocol payloads, passed through as raw bytes, so there is
+no protobuf code generation. Concurrent calls of an ensemble share a few
+long-lived HTTP/2 connections instead of one HTTP/1.1 connection each.
+"""
+
+import logging
+import struct
+from collections.abc import Awaitable, Callable
+
+import grpc
+
+from util.tensor_protocol import GRPC_PREDICT_METHOD, TensorRequest, decode_request
+
+# 8MB, room for the largest model inputs (600x600x3)
+MAX_MESSAGE_LENGTH = 8 * 1024 * 1024
+
+
+def create_server(
+    predict: Callable[[TensorRequest], Awaitable[bytes]],
+    port: int,
+    max_concurrent_rpcs: int | None = None,
+) -> grpc.aio.Server:
+    """
+    gRPC server answering GRPC_PREDICT_METHOD with predict, not started yet.
+
+    predict raises LookupError for a model that isn't hosted and ValueError
+    for an invalid request.
+    """
+    service, method = GRPC_PREDICT_METHOD.strip("/").split("/")
+
+    async def handle(payload: bytes, context: grpc.aio.ServicerContext) -> bytes:
+        try:
+            request = decode_request(payload)
+        except (ValueError, KeyError, struct.error) as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Bad request: {e}")
+        try:
+            return await predict(request)
+        except LookupError as e:
+            await context.abort(grpc.StatusCode.NOT_FOUND, str(e))
+        except ValueError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        except Exception as e:
+            logging.exception(f"gRPC inference failed: {e}")
+            await context.abort(grpc.StatusCode.INTERNAL, str(e))
+
+    server = grpc.aio.server(
+        options=[
+            ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+            ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+        ],
+        maximum_concurrent_rpcs=max_concurrent_rpcs,
+    )
+    server.add_generic_rpc_handlers(
+        (
+            grpc.method_handlers_generic_handler(
+                service, {method: grpc.unary_unary_rpc_method_handler(handle)}
+            ),
+        )
+    )
+    server.add_insecure_port(f"[::]:{port}")
+    return server
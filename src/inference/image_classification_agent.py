@@ -1,7 +1,11 @@
+import logging
+import threading
+
 import cv2
 import numpy as np
 import onnxruntime as ort
 from datamodel import ImageClassificationModelEnum, ModelConfig
+from model_cache import ModelCache
 from numpy._typing import NDArray
 
 from util.classes import IMAGENET2012_CLASSES
@@ -9,6 +13,30 @@ from util.preprocessing import preprocess_input
 
 key_list = list(IMAGENET2012_CLASSES.keys())
 
+_shared_environment_configured = False
+
+
+def configure_shared_environment(intra_op_num_threads: int, inter_op_num_threads: int):
+    """
+    Give every session of this process one ORT thread pool and one CPU arena.
+
+    Must run before the first InferenceSession is created, agents then opt in
+    with `shared_environment=True`.
+    """
+    global _shared_environment_configured
+    if _shared_environment_configured:
+        return
+    ort.capi._pybind_state.set_global_thread_pool_sizes(
+        intra_op_num_threads, inter_op_num_threads
+    )
+    ort.create_and_register_allocator(
+        ort.OrtMemoryInfo(
+            "Cpu", ort.OrtAllocatorType.ORT_ARENA_ALLOCATOR, 0, ort.OrtMemType.DEFAULT
+        ),
+        None,
+    )
+    _shared_environment_configured = True
+
 
 class ImageClassificationAgent:
     def __init__(
@@ -16,42 +44,117 @@ class ImageClassificationAgent:
         chosen_model: ImageClassificationModelEnum,
         model_config: ModelConfig,
         execution_provider: str | None = None,
+        intra_op_num_threads: int = 0,
+        inter_op_num_threads: int = 0,
+        shared_environment: bool = False,
+        model_cache: ModelCache | None = None,
     ):
-        session_options = ort.SessionOptions()
+        def session_options() -> ort.SessionOptions:
+            options = ort.SessionOptions()
+            if shared_environment:
+                options.use_per_session_threads = False
+                options.add_session_config_entry("session.use_env_allocators", "1")
+            else:
+                options.intra_op_num_threads = intra_op_num_threads
+                options.inter_op_num_threads = inter_op_num_threads
+            return options
+
         providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
         if execution_provider is not None:
             providers.insert(0, execution_provider)
-        self.session = ort.InferenceSession(
-            f"./onnx_model/{chosen_model.name}.onnx",
-            providers=providers,
-            sess_options=session_options,
-        )
+        model_name = chosen_model.name
+        if model_config.model_variant:
+            model_name = f"{model_name}_{model_config.model_variant}"
+        model_path = f"./onnx_model/{model_name}.onnx"
+        session = None
+        if model_cache is not None:
+            session, model_path = model_cache.load(
+                model_path, providers, session_options
+            )
+        if session is None:
+            session = ort.InferenceSession(
+                model_path,
+                providers=providers,
+                sess_options=session_options(),
+            )
+        self.session = session
+        logging.info(f"Loaded {chosen_model.name} from {model_path}")
         self.model_config = model_config
 
         self.input_name = self.session.get_inputs()[0].name
+        # NOTE: models exported by create_uint8_input_onnx_model.py normalize the
+        # raw image inside the graph, so the request buffer is fed as is
+        self.uint8_input = self.session.get_inputs()[0].type == "tensor(uint8)"
+        # Preprocessed input buffers, one per executor thread since ORT reads
+        # the buffer for the whole session.run
+        self._buffers = threading.local()
+
+    def _input_buffer(self, batch_size: int, image_shape: tuple[int, ...]) -> NDArray:
+        buffer = getattr(self._buffers, "input", None)
+        if (
+            buffer is None
+            or buffer.shape[1:] != image_shape
+            or buffer.shape[0] < batch_size
+        ):
+            buffer = np.empty((batch_size, *image_shape), dtype=np.float32)
+            self._buffers.input = buffer
+        return buffer[:batch_size]
 
     def reshape(self, image_array: NDArray, enlarge: bool):
         # NOTE: interpolation choice taken from https://stackoverflow.com/questions/23853632/which-kind-of-interpolation-best-for-resizing-image
+        _, height, width, _ = self.model_config.input_shape
         reshaped_image = cv2.resize(
             image_array,
-            self.model_config.input_shape[1:2],
+            (width, height),
             interpolation=cv2.INTER_LINEAR if enlarge else cv2.INTER_AREA,
         )
         return reshaped_image
 
-    def predict(self, image_array: NDArray):
-        if image_array.shape[1] != self.model_config.input_shape[1]:
+    def _prepare(self, image_array: NDArray) -> NDArray:
+        # A frame of another size than the model input (e.g. the ensemble had
+        # no frame of this size) is resized here
+        input_size = tuple(self.model_config.input_shape[1:3])
+        if image_array.shape[:2] != input_size:
             image_array = self.reshape(
-                image_array, image_array.shape[1] > self.model_config.input_shape[1]
+                image_array, image_array.shape[0] < input_size[0]
             )
+        return image_array
 
-        image_array = preprocess_input(image_array, mode=self.model_config.input_mode)
+    def predict_probabilities_batch(self, image_arrays: list[NDArray]) -> NDArray:
+        """Full (batch, 1000) probability matrix, one row per input image."""
+        # NOTE: models are exported with a None batch dimension, so the whole
+        # batch goes through a single session.run
+        image_arrays = [self._prepare(image_array) for image_array in image_arrays]
+        if self.uint8_input:
+            if len(image_arrays) == 1:
+                batch = image_arrays[0][np.newaxis]
+            else:
+                batch = np.stack(image_arrays)
+        else:
+            batch = self._input_buffer(len(image_arrays), image_arrays[0].shape)
+            for image_array, out in zip(image_arrays, batch, strict=True):
+                preprocess_input(
+                    image_array, mode=self.model_config.input_mode, out=out
+                )
 
-        if len(image_array.shape) != 4:
-            image_array = np.expand_dims(image_array, axis=0)
+        outputs = self.session.run(None, {self.input_name: batch})
+        return outputs[0]
 
-        outputs = self.session.run(None, {self.input_name: image_array})
-        outputs = outputs[0]
+    @staticmethod
+    def top1(probabilities: NDArray) -> tuple[str, float]:
+        predicted_class_index = int(np.argmax(probabilities))
+        return key_list[predicted_class_index], float(
+            probabilities[predicted_class_index]
+        )
 
-        predicted_class_index = np.argmax(outputs, axis=1)[0]
-        return key_list[predicted_class_index], float(outputs[0][predicted_class_index])
+    def predict_batch(self, image_arrays: list[NDArray]):
+        outputs = self.predict_probabilities_batch(image_arrays)
+        return [self.top1(output) for output in outputs]
+
+    def predict_probabilities(self, image_array: NDArray) -> NDArray:
+        if len(image_array.shape) == 4:
+            image_array = image_array[0]
+        return self.predict_probabilities_batch([image_array])[0]
+
+    def predict(self, image_array: NDArray):
+        return self.top1(self.predict_probabilities(image_array))
@@ -1,27 +1,52 @@
+import asyncio
 import logging
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
 import numpy as np
 import yaml
 from datamodel import ImageClassificationModelEnum, InferenceServiceConfig
-from fastapi import FastAPI, Request
-from image_classification_agent import ImageClassificationAgent
+from dynamic_batcher import DynamicBatcher
+from fastapi import FastAPI, HTTPException, Request, Response, status
+from image_classification_agent import (
+    ImageClassificationAgent,
+    configure_shared_environment,
+)
+from model_cache import ModelCache
+from opentelemetry import metrics
+from prediction_cache import PredictionCache
 
+from util.tensor_protocol import (
+    MEDIA_TYPE,
+    TensorRequest,
+    check_image_size,
+    encode_prediction,
+    negotiate,
+    square_size,
+)
 from util.utils import setup_otel
 
 current_directory = os.path.dirname(os.path.abspath(__file__))
 util_directory = os.path.join(current_directory, "..", "util")
 sys.path.append(util_directory)
 
+# NOTE: with MULTI_MODEL one process serves every model in `hosted_models`
+MULTI_MODEL = os.environ.get("MULTI_MODEL", "false").lower() == "true"
+
 # Set up logging with service name and instance
 default_model = "MobileNetV2"
 SERVICE_NAME = os.environ.get(
-    "SERVICE_NAME", f"inference-{os.environ.get('CHOSEN_MODEL', default_model).lower()}"
+    "SERVICE_NAME",
+    "inference"
+    if MULTI_MODEL
+    else f"inference-{os.environ.get('CHOSEN_MODEL', default_model).lower()}",
 )
 setup_otel(SERVICE_NAME)
+meter = metrics.get_meter(SERVICE_NAME)
 
-chosen_model = os.environ["CHOSEN_MODEL"]
 # NOTE: model config in the inference service config
 #
 MODEL_CONFIG = {
@@ -52,16 +77,264 @@ except Exception as e:
     sys.exit(1)
 logging.debug(f"Inference configuration: {config}")
 
-chosen_model = ImageClassificationModelEnum[chosen_model]
+if MULTI_MODEL:
+    hosted_models = config.hosted_models
+    if not hosted_models:
+        logging.error("MULTI_MODEL is set but hosted_models is empty")
+        sys.exit(1)
+else:
+    hosted_models = [ImageClassificationModelEnum[os.environ["CHOSEN_MODEL"]]]
+# Model answering the plain /inference route
+chosen_model = hosted_models[0]
+
+runtime_config = config.runtime
+# NOTE: every executor worker runs its own session.run, so the ORT thread pool
+# of each run only gets its share of the cores available to this process
+intra_op_num_threads = runtime_config.intra_op_num_threads or max(
+    1, len(os.sched_getaffinity(0)) // runtime_config.executor_workers
+)
+logging.info(
+    f"Running {[model.name for model in hosted_models]} on "
+    f"{runtime_config.executor_workers} worker(s) with "
+    f"{intra_op_num_threads} intra-op thread(s) each"
+)
+
+if MULTI_MODEL:
+    # All sessions share one thread pool and allocator instead of one per model
+    configure_shared_environment(
+        intra_op_num_threads, runtime_config.inter_op_num_threads
+    )
+
+# NOTE: a missing cache entry is built on first start, the next pod starting on
+# the same cache volume (or image, see model_cache.py) skips the optimization
+model_cache = None
+if config.model_cache.enabled:
+    model_cache = ModelCache(config.model_cache.directory)
+
+ml_agents = {
+    model.name: ImageClassificationAgent(
+        model,
+        config.model_config_dict[model],
+        intra_op_num_threads=intra_op_num_threads,
+        inter_op_num_threads=runtime_config.inter_op_num_threads,
+        shared_environment=MULTI_MODEL,
+        model_cache=model_cache,
+    )
+    for model in hosted_models
+}
+
+# Shared by every hosted model so the number of concurrent session.run calls
+# stays bounded no matter which model the requests go to
+executor = ThreadPoolExecutor(
+    max_workers=runtime_config.executor_workers, thread_name_prefix="inference"
+)
+inference_slots = asyncio.Semaphore(
+    runtime_config.max_concurrency or runtime_config.executor_workers
+)
+
+batchers: dict[str, DynamicBatcher] = {}
+if config.batching.enabled:
+    batchers = {
+        model_name: DynamicBatcher(
+            ml_agent.predict_probabilities_batch,
+            max_batch_size=config.batching.max_batch_size,
+            max_wait_ms=config.batching.max_wait_ms,
+            executor=executor,
+            slots=inference_slots,
+        )
+        for model_name, ml_agent in ml_agents.items()
+    }
+
+
+prediction_cache = None
+if config.prediction_cache.enabled:
+    prediction_cache = PredictionCache(
+        max_entries=config.prediction_cache.max_entries,
+        max_memory_mb=config.prediction_cache.max_memory_mb,
+        ttl_s=config.prediction_cache.ttl_s,
+    )
+
+
+warmup_config = config.warmup
+# Largest batch first so the per-thread input buffers are allocated once
+warmup_batch_sizes = sorted(
+    set(
+        warmup_config.batch_sizes
+        or [1, config.batching.max_batch_size if config.batching.enabled else 1]
+    ),
+    reverse=True,
+)
+warmup_state = {"ready": not warmup_config.enabled, "error": None, "timings_ms": {}}
+warmup_run_duration = meter.create_histogram(
+    "inference.warmup.run_duration",
+    unit="ms",
+    description="Latency of each synthetic warm-up batch",
+)
+warmup_total_duration = meter.create_histogram(
+    "inference.warmup.duration",
+    unit="ms",
+    description="Time from startup until the pod reports ready",
+)
+
+
+def timed_predict(ml_agent: ImageClassificationAgent, images: list) -> float:
+    start = time.perf_counter()
+    ml_agent.predict_probabilities_batch(images)
+    return (time.perf_counter() - start) * 1000
 
-model_config = config.model_config_dict[chosen_model]
-ml_agent = ImageClassificationAgent(chosen_model, model_config)
 
-app = FastAPI()
+async def warm_up():
+    """Run synthetic batches through every hosted model on every executor worker."""
+    loop = asyncio.get_running_loop()
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    try:
+        for model_name, ml_agent in ml_agents.items():
+            timings = warmup_state["timings_ms"].setdefault(model_name, {})
+            for batch_size in warmup_batch_sizes:
+                height, width = ml_agent.model_config.input_shape[1:3]
+                images = list(
+                    rng.integers(0, 256, (batch_size, height, width, 3), dtype=np.uint8)
+                )
+                for iteration in range(warmup_config.iterations):
+                    # One batch per worker thread, each has its own buffers
+                    durations = await asyncio.gather(
+                        *[
+                            loop.run_in_executor(
+                                executor, timed_predict, ml_agent, images
+                            )
+                            for _ in range(runtime_config.executor_workers)
+                        ]
+                    )
+                    for duration in durations:
+                        warmup_run_duration.record(
+                            duration,
+                            {
+                                "model": model_name,
+                                "batch_size": batch_size,
+                                "iteration": iteration,
+                            },
+                        )
+                    timings.setdefault(batch_size, []).append(round(max(durations), 3))
+    except Exception as e:
+        # NOTE: stays not ready, a pod that can't run its model gets no traffic
+        logging.exception("Warm-up failed")
+        warmup_state["error"] = str(e)
+        return
+
+    total_duration = (time.perf_counter() - start) * 1000
+    warmup_total_duration.record(total_duration)
+    warmup_state["ready"] = True
+    logging.info(
+        f"Warm-up done in {total_duration:.0f}ms: {warmup_state['timings_ms']}"
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for batcher in batchers.values():
+        await batcher.start()
+    # In the background so /health answers while the models warm up
+    warmup_task = asyncio.create_task(warm_up()) if warmup_config.enabled else None
+    grpc_server = None
+    if config.grpc.enabled:
+        # NOTE: imported here so the REST-only deployments don't need grpcio
+        from grpc_server import create_server
+
+        grpc_server = create_server(
+            grpc_predict, config.grpc.port, config.grpc.max_concurrent_rpcs
+        )
+        await grpc_server.start()
+        logging.info(f"gRPC inference listening on port {config.grpc.port}")
+    yield
+    if grpc_server is not None:
+        await grpc_server.stop(grace=5)
+    if warmup_task is not None:
+        warmup_task.cancel()
+    for batcher in batchers.values():
+        await batcher.stop()
+    executor.shutdown(wait=True)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/health")
+async def health():
+    """Liveness, the process is up and serving."""
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+async def ready(response: Response):
+    """Readiness, not ready (503) until the warm-up finished."""
+    if not warmup_state["ready"]:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return warmup_state
 
 
 @app.post("/inference")
 async def inference(request: Request):
+    return await run_inference(chosen_model.name, request)
+
+
+@app.post("/inference/{model}")
+async def inference_model(model: str, request: Request):
+    if model not in ml_agents:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Model {model} is not hosted, available: {list(ml_agents)}",
+        )
+    return await run_inference(model, request)
+
+
+@app.get("/prediction_cache")
+async def prediction_cache_stats():
+    if prediction_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **prediction_cache.stats()}
+
+
+async def predict_probabilities(model_name: str, image: np.ndarray) -> np.ndarray:
+    if model_name in batchers:
+        return await batchers[model_name].submit(image)
+    async with inference_slots:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, ml_agents[model_name].predict_probabilities, image
+        )
+
+
+async def cached_probabilities(
+    model_name: str, image_bytes: bytes | memoryview, image: np.ndarray
+) -> np.ndarray:
+    if prediction_cache is None:
+        return await predict_probabilities(model_name, image)
+    return await prediction_cache.get_or_compute(
+        prediction_cache.key(model_name, image_bytes),
+        lambda: predict_probabilities(model_name, image),
+    )
+
+
+async def grpc_predict(request: TensorRequest) -> bytes:
+    """Encoded prediction for a gRPC request, an empty model_id is chosen_model."""
+    model_name = request.model_id or chosen_model.name
+    if model_name not in ml_agents:
+        raise LookupError(
+            f"Model {model_name} is not hosted, available: {list(ml_agents)}"
+        )
+    image = request.image
+    if image.ndim != 3 or image.shape[2] != 3:
+        raise ValueError(f"Expected a HxWx3 image, got shape {image.shape}")
+    check_image_size(image.shape[:2])
+    probabilities = await cached_probabilities(model_name, image.data, image)
+    return encode_prediction(
+        model_name, probabilities, top_k=request.top_k, dtype=request.dtype
+    )
+
+
+async def run_inference(model_name: str, request: Request):
+    ml_agent = ml_agents[model_name]
     image_bytes = await request.body()
 
     # headers = dict(request.headers)
@@ -75,9 +348,35 @@ async def inference(request: Request):
     # logging.info(image_bytes)
     # with tracer.start_span("inference"):
     image_array = np.frombuffer(image_bytes, dtype=np.uint8)
-    # # NOTE: Here we assume that the processing service has reshape the input image to size 224,224,3
-    reconstructed_image = image_array.reshape((224, 224, 3))
-    return ml_agent.predict(reconstructed_image)
+    # NOTE: a square RGB frame, the ensemble sends the one of the model's input
+    # size when preprocessing made it, the agent resizes any other
+    try:
+        reconstructed_image = image_array.reshape((*square_size(len(image_bytes)), 3))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    probabilities = await cached_probabilities(
+        model_name, image_bytes, reconstructed_image
+    )
+
+    # NOTE: clients sending `Accept: application/x-prediction-tensor` get the
+    # packed probability vector (optionally top-k) instead of the top-1 JSON
+    try:
+        tensor_options = negotiate(request.headers.get("accept"))
+        if tensor_options is not None:
+            payload = encode_prediction(
+                model_name,
+                probabilities,
+                top_k=tensor_options["top_k"],
+                dtype=tensor_options["dtype"],
+            )
+    except (TypeError, ValueError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail=f"Unsupported tensor response options: {e}",
+        )
+    if tensor_options is not None:
+        return Response(content=payload, media_type=MEDIA_TYPE)
+    return ml_agent.top1(probabilities)
 
 
 if os.environ.get("MANUAL_TRACING"):
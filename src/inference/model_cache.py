@@ -0,0 +1,165 @@
+"""
+Cache of pre-optimized ORT format models.
+
+Entries are keyed by the path, size and modification time of the source ONNX
+model, the ONNX Runtime version and the execution providers, so replacing the
+model or upgrading either invalidates them. Hashing the model itself would
+read every byte of it at each pod start, hit or miss.
+Run this file to prebuild the entries of every model in ./onnx_model, e.g. in
+the image build, so pods skip graph optimization at startup.
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import tempfile
+from collections.abc import Callable
+
+import onnxruntime as ort
+
+DEFAULT_CACHE_DIRECTORY = "./onnx_model_cache"
+
+# NOTE: ORT_ENABLE_ALL adds layout optimizations tied to the CPU the model was
+# optimized on, extended optimizations are safe to reuse across nodes
+CACHE_OPTIMIZATION_LEVEL = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+
+
+def available_providers(providers: list[str]) -> list[str]:
+    available = ort.get_available_providers()
+    return [provider for provider in providers if provider in available]
+
+
+def file_signature(path: str) -> str:
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class ModelCache:
+    def __init__(self, directory: str = DEFAULT_CACHE_DIRECTORY):
+        self.directory = directory
+
+    def key(self, model_path: str, providers: list[str]) -> str:
+        digest = hashlib.sha256()
+        digest.update(file_signature(model_path).encode())
+        digest.update(ort.__version__.encode())
+        digest.update(",".join(available_providers(providers)).encode())
+        digest.update(str(CACHE_OPTIMIZATION_LEVEL).encode())
+        return digest.hexdigest()[:16]
+
+    def entry_path(self, model_path: str, providers: list[str]) -> str:
+        model_name = os.path.splitext(os.path.basename(model_path))[0]
+        return os.path.join(
+            self.directory, f"{model_name}-{self.key(model_path, providers)}.ort"
+        )
+
+    def lookup(self, model_path: str, providers: list[str]) -> str | None:
+        entry = self.entry_path(model_path, providers)
+        if os.path.isfile(entry) and os.path.getsize(entry) > 0:
+            return entry
+        return None
+
+    def build(
+        self,
+        model_path: str,
+        providers: list[str],
+        session_options: ort.SessionOptions | None = None,
+    ) -> tuple[str, ort.InferenceSession]:
+        """
+        Optimize the model into its cache entry. The optimizing session is
+        returned with it, created with session_options, so a caller loading
+        the model on a miss doesn't optimize it a second time.
+        """
+        entry = self.entry_path(model_path, providers)
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Written next to the entry and renamed, so concurrent pods sharing the
+        # cache volume never load a half written file
+        fd, tmp_path = tempfile.mkstemp(suffix=".ort", dir=self.directory)
+        os.close(fd)
+        try:
+            session_options = session_options or ort.SessionOptions()
+            session_options.graph_optimization_level = CACHE_OPTIMIZATION_LEVEL
+            session_options.optimized_model_filepath = tmp_path
+            session_options.add_session_config_entry("session.save_model_format", "ORT")
+            session = ort.InferenceSession(
+                model_path, sess_options=session_options, providers=providers
+            )
+            os.replace(tmp_path, entry)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        logging.info(f"Cached optimized {model_path} as {entry}")
+        return entry, session
+
+    def load(
+        self,
+        model_path: str,
+        providers: list[str],
+        session_options: Callable[[], ort.SessionOptions],
+        build_on_miss: bool = True,
+    ) -> tuple[ort.InferenceSession | None, str]:
+        """
+        Session of the cache entry of the model and its path, built on a
+        miss. (None, model_path) when the cache can't be used. session_options
+        makes the options of each session created.
+        """
+        try:
+            entry = self.lookup(model_path, providers)
+        except Exception as e:
+            logging.warning(f"Model cache unavailable for {model_path}: {e}")
+            return None, model_path
+        if entry is not None:
+            try:
+                session = ort.InferenceSession(
+                    entry, providers=providers, sess_options=session_options()
+                )
+                return session, entry
+            except Exception as e:
+                # A corrupt or incompatible entry must not keep the pod from starting
+                logging.warning(f"Failed to load cached {entry}: {e}")
+                self.invalidate(entry)
+        if not build_on_miss:
+            return None, model_path
+        try:
+            # NOTE: this pod runs the model at CACHE_OPTIMIZATION_LEVEL, the
+            # next ones load the entry
+            entry, session = self.build(model_path, providers, session_options())
+        except Exception as e:
+            logging.warning(f"Model cache unavailable for {model_path}: {e}")
+            return None, model_path
+        return session, entry
+
+    def invalidate(self, entry: str):
+        try:
+            os.remove(entry)
+        except OSError as e:
+            logging.warning(f"Failed to remove cache entry {entry}: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-dir", default="./onnx_model")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIRECTORY)
+    parser.add_argument(
+        "--providers",
+        nargs="+",
+        default=["CUDAExecutionProvider", "CPUExecutionProvider"],
+        help="execution providers the inference service runs with",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not os.path.isdir(args.model_dir):
+        logging.warning(f"No model directory {args.model_dir}, nothing to cache")
+        raise SystemExit(0)
+
+    cache = ModelCache(args.cache_dir)
+    providers = available_providers(args.providers)
+    for file_name in sorted(os.listdir(args.model_dir)):
+        if file_name.endswith(".onnx"):
+            model_path = os.path.join(args.model_dir, file_name)
+            if cache.lookup(model_path, providers) is None:
+                cache.build(model_path, providers)
+            else:
+                logging.info(f"{model_path} is already cached")
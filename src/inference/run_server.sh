@@ -4,6 +4,7 @@
 debug=false
 PORT=5012
 CHOSEN_MODEL="MobileNetV2"
+MULTI_MODEL=false
 
 export LOG_LEVEL=${LOG_LEVEL:-INFO}
 LOG_LEVEL_LOWER=$(echo "$LOG_LEVEL" | tr '[:upper:]' '[:lower:]')
@@ -12,6 +13,7 @@ LOG_LEVEL_LOWER=$(echo "$LOG_LEVEL" | tr '[:upper:]' '[:lower:]')
 while [[ "$#" -gt 0 ]]; do
   case $1 in
   --debug) debug=true ;;
+  --multi) MULTI_MODEL=true ;;
   --port)
     PORT="$2"
     shift
@@ -30,6 +32,7 @@ done
 
 export PORT
 export CHOSEN_MODEL
+export MULTI_MODEL
 
 if [[ "$debug" == true ]]; then
   fastapi dev --host 0.0.0.0 --port "$PORT" inference.py
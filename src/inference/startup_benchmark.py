@@ -0,0 +1,72 @@
+"""
+Cold-start benchmark of the model artifact cache.
+
+For every model in ./onnx_model, compares the InferenceSession creation time
+from the raw ONNX model (graph optimization at startup) with the time from
+its pre-optimized ORT format cache entry, plus the first session.run.
+
+    python startup_benchmark.py --repeat 3
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+import numpy as np
+import onnxruntime as ort
+from model_cache import DEFAULT_CACHE_DIRECTORY, ModelCache, available_providers
+
+
+def time_startup(model_path: str, providers: list[str], repeat: int):
+    load_times = []
+    first_run_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        session = ort.InferenceSession(
+            model_path, sess_options=ort.SessionOptions(), providers=providers
+        )
+        loaded = time.perf_counter()
+
+        model_input = session.get_inputs()[0]
+        shape = [1 if not isinstance(dim, int) else dim for dim in model_input.shape]
+        dtype = np.uint8 if model_input.type == "tensor(uint8)" else np.float32
+        session.run(None, {model_input.name: np.zeros(shape, dtype=dtype)})
+
+        load_times.append((loaded - start) * 1000)
+        first_run_times.append((time.perf_counter() - loaded) * 1000)
+    return statistics.median(load_times), statistics.median(first_run_times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-dir", default="./onnx_model")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIRECTORY)
+    parser.add_argument("--model", nargs="*", help="model names, all when omitted")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    providers = available_providers(["CUDAExecutionProvider", "CPUExecutionProvider"])
+    cache = ModelCache(args.cache_dir)
+    models = args.model or sorted(
+        os.path.splitext(file_name)[0]
+        for file_name in os.listdir(args.model_dir)
+        if file_name.endswith(".onnx")
+    )
+
+    print(
+        f"{'model':<24} {'raw load':>10} {'cached load':>12} {'gain':>7} "
+        f"{'raw 1st run':>12} {'cached 1st run':>15}"
+    )
+    for model in models:
+        model_path = os.path.join(args.model_dir, f"{model}.onnx")
+        entry = (
+            cache.lookup(model_path, providers) or cache.build(model_path, providers)[0]
+        )
+
+        raw_load, raw_run = time_startup(model_path, providers, args.repeat)
+        cached_load, cached_run = time_startup(entry, providers, args.repeat)
+        print(
+            f"{model:<24} {raw_load:>8.0f}ms {cached_load:>10.0f}ms "
+            f"{raw_load / cached_load:>6.1f}x {raw_run:>10.0f}ms {cached_run:>13.0f}ms"
+        )
@@ -63,24 +63,52 @@ async def process_message(message: aio_pika.IncomingMessage, session):
 
         return future
 
+    def insert_result(data: dict):
+        data["endtime"] = time.time()
+        request_id = uuid.UUID(data.get("request_id", str(uuid.uuid4())))
+        prediction_result = data["prediction"][0]
+        timestamp = data.get("timestamp", time.time())
+        dt_object = datetime.datetime.fromtimestamp(float(timestamp))
+
+        query = f"""
+            INSERT INTO {KEYSPACE}.{TABLE_NAME}
+                (id, timestamp, prediction, confidence, provisional, version)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """
+        values = [
+            request_id,
+            dt_object,
+            prediction_result[0],
+            prediction_result[1],
+            data.get("provisional", False),
+            data.get("version"),
+        ]
+        # NOTE: a provisional result and its refinement share the row, the
+        # version (microseconds) is the write time so the refined one wins
+        # whichever message is inserted last
+        if data.get("version") is not None:
+            query += " USING TIMESTAMP %s"
+            values.append(int(data["version"]))
+        response_future = session.execute_async(SimpleStatement(query), values)
+        return request_id, bridge_future(response_future, loop)
+
     async with message.process():
         try:
             body = message.body.decode()
             data = json.loads(body)
-            data["endtime"] = time.time()
-            request_id = uuid.UUID(data.get("request_id", str(uuid.uuid4())))
-            prediction_result = data["prediction"][0]
-            timestamp = data.get("timestamp", time.time())
-            dt_object = datetime.datetime.fromtimestamp(float(timestamp))
-
-            query = f"""
-                INSERT INTO {KEYSPACE}.{TABLE_NAME} (id, timestamp, prediction, confidence)
-                VALUES (%s, %s, %s, %s)
-            """
-            values = (request_id, dt_object, prediction_result[0], prediction_result[1])
+            # NOTE: the ensemble publishes its results in batches, a message
+            # holds a JSON array of results (a single object for older senders)
+            results = data if isinstance(data, list) else [data]
 
             loop = asyncio.get_running_loop()
-            response_future = session.execute_async(SimpleStatement(query), values)
+            inserts = []
+            for result in results:
+                # NOTE: a malformed result is skipped, not the rest of the batch
+                try:
+                    inserts.append(insert_result(result))
+                except Exception as e:
+                    logging.error(f"Skipping malformed result {result}: {e}")
+            request_ids = [request_id for request_id, _ in inserts]
 
             if tracer:
                 with tracer.start_as_current_span("process_message") as span:
@@ -91,16 +119,17 @@ async def process_message(message: aio_pika.IncomingMessage, session):
                     span.set_attribute(
                         "rabbitmq.routing_key", message.routing_key or "unknown"
                     )
+                    span.set_attribute("rabbitmq.batch_size", len(results))
                     logging.info(f"{current_process().name} received: {data}")
-                    await bridge_future(response_future, loop)
+                    await asyncio.gather(*[insert for _, insert in inserts])
                     logging.info(
-                        f"{current_process().name} inserted request_id: {request_id}"
+                        f"{current_process().name} inserted request_id: {request_ids}"
                     )
             else:
                 logging.info(f"{current_process().name} received: {data}")
-                await bridge_future(response_future, loop)
+                await asyncio.gather(*[insert for _, insert in inserts])
                 logging.info(
-                    f"{current_process().name} inserted request_id: {request_id}"
+                    f"{current_process().name} inserted request_id: {request_ids}"
                 )
 
         except Exception as e:
@@ -0,0 +1,84 @@
+"""
+Images of a /preprocessing/batch request.
+
+A batch is a multi-file multipart upload, each file an image or a tar/zip
+archive of images, or a tar/zip archive sent as the request body. Archive
+members are read in order, directories and files without an image extension
+are skipped.
+"""
+
+import io
+import os
+import tarfile
+import zipfile
+
+ARCHIVE_TYPES = {
+    "application/x-tar": "tar",
+    "application/tar": "tar",
+    "application/gzip": "tar",
+    "application/x-gtar": "tar",
+    "application/zip": "zip",
+    "application/x-zip-compressed": "zip",
+}
+IMAGE_EXTENSIONS = (".png", ".jpeg", ".jpg", ".heic", ".heif", ".heics")
+
+
+class BatchUploadError(ValueError):
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _is_image(name: str) -> bool:
+    base = os.path.basename(name)
+    # NOTE: macOS archives carry ._ resource forks next to the images
+    return not base.startswith(".") and base.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _check_size(name: str, size: int, max_image_bytes: int):
+    if size > max_image_bytes:
+        raise BatchUploadError(
+            f"{name} is larger than {max_image_bytes} bytes", status_code=413
+        )
+
+
+def _tar_members(data: bytes, max_image_bytes: int):
+    try:
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as archive:
+            for member in archive:
+                if member.isfile() and _is_image(member.name):
+                    _check_size(member.name, member.size, max_image_bytes)
+                    yield member.name, archive.extractfile(member).read()
+    except tarfile.TarError as e:
+        raise BatchUploadError(f"Invalid tar archive: {e}") from None
+
+
+def _zip_members(data: bytes, max_image_bytes: int):
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and _is_image(info.filename):
+                    # Uncompressed size, checked before inflating anything
+                    _check_size(info.filename, info.file_size, max_image_bytes)
+                    yield info.filename, archive.read(info)
+    except zipfile.BadZipFile as e:
+        raise BatchUploadError(f"Invalid zip archive: {e}") from None
+
+
+def read_archive(
+    data: bytes, content_type: str, max_images: int, max_image_bytes: int
+) -> list[tuple[str, bytes]]:
+    """(name, data) of the images of an archive, at most max_images."""
+    members = (
+        _zip_members(data, max_image_bytes)
+        if ARCHIVE_TYPES[content_type] == "zip"
+        else _tar_members(data, max_image_bytes)
+    )
+    images = []
+    for name, image in members:
+        if len(images) == max_images:
+            raise BatchUploadError(
+                f"More than {max_images} images in a batch", status_code=413
+            )
+        images.append((name, image))
+    return images
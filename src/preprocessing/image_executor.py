@@ -0,0 +1,154 @@
+"""
+Off-loop execution of the CPU-bound image work of the preprocessing service.
+
+- process: a pool of worker processes, decoding scales with the cores of the pod
+- thread: a thread pool, cv2 releases the GIL while decoding and resizing
+- inline: on the event loop, as before
+
+At most `workers + max_queued` images are accepted at once, run() raises
+ExecutorBusyError beyond that instead of queueing without bound. map() takes
+the images of a batch upload together, or none of them.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+from collections.abc import Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+from opentelemetry import metrics
+
+meter = metrics.get_meter(__name__)
+
+EXECUTOR_TYPES = ("process", "thread", "inline")
+
+
+class ExecutorBusyError(Exception):
+    def __init__(self, retry_after: int = 1):
+        super().__init__(f"Image executor busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _init_worker(initializer: Callable | None, initargs: tuple):
+    # One image per process at a time, cv2's own threads would oversubscribe
+    cv2.setNumThreads(1)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+class ImageExecutor:
+    def __init__(
+        self,
+        executor_type: str = "process",
+        workers: int = 0,
+        max_queued: int = 64,
+        initializer: Callable | None = None,
+        initargs: tuple = (),
+    ):
+        """initializer(*initargs) sets up each worker process, e.g. its pipeline."""
+        if executor_type not in EXECUTOR_TYPES:
+            raise ValueError(
+                f"Unknown executor {executor_type}, expected one of {EXECUTOR_TYPES}"
+            )
+        self.executor_type = executor_type
+        # 0: one worker per core available to the pod
+        self.workers = workers or len(os.sched_getaffinity(0))
+        self.max_queued = max_queued
+        self.initializer = initializer
+        self.initargs = initargs
+        self._executor: Executor | None = None
+        # Images admitted (running or queued), reserved before any await so
+        # the check and the reservation can't interleave with other uploads
+        self._in_flight = 0
+
+        self._rejections = meter.create_counter(
+            "preprocessing.executor.rejections",
+            description="Images rejected because the executor queue was full",
+        )
+        meter.create_observable_gauge(
+            "preprocessing.executor.in_flight",
+            callbacks=[lambda options: [metrics.Observation(self._in_flight)]],
+            description="Images running or queued in the executor",
+        )
+
+    def start(self):
+        if self.executor_type == "process":
+            # NOTE: spawn, forking a process with live cv2/OTel threads isn't safe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.initializer, self.initargs),
+            )
+        elif self.executor_type == "thread":
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="preprocessing"
+            )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _restart(self):
+        executor = self._executor
+        self.start()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def free_slots(self) -> int:
+        """Images that can still be accepted before run() raises."""
+        return self.workers + self.max_queued - self._in_flight
+
+    def _reserve(self, count: int):
+        if count > self.free_slots():
+            self._rejections.add(count)
+            raise ExecutorBusyError()
+        self._in_flight += count
+
+    async def map(self, func: Callable, args_list: list[tuple]) -> list:
+        """
+        func(*args) for each args concurrently, in order. All of them are
+        admitted at once or ExecutorBusyError is raised up front.
+        """
+        self._reserve(len(args_list))
+        try:
+            tasks = [
+                asyncio.ensure_future(self._run(func, *args)) for args in args_list
+            ]
+            try:
+                return await asyncio.gather(*tasks)
+            except BaseException:
+                # Don't keep decoding the rest of a failed batch
+                for task in tasks:
+                    task.cancel()
+                raise
+        finally:
+            self._in_flight -= len(args_list)
+
+    async def run(self, func: Callable, *args):
+        """func(*args) in the executor, raises ExecutorBusyError when full."""
+        self._reserve(1)
+        try:
+            return await self._run(func, *args)
+        finally:
+            self._in_flight -= 1
+
+    async def _run(self, func: Callable, *args):
+        executor = self._executor
+        if executor is None:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM killed), replace the pool so the
+            # next images don't all fail, this one can be retried. Every
+            # image in flight gets the error, the first one restarts
+            if self._executor is executor:
+                logging.error("Image worker process died, restarting the pool")
+                self._restart()
+            raise ExecutorBusyError() from None
@@ -5,22 +5,47 @@ from cv2.typing import MatLike
 
 # because the nature of the object detection task
 # preserving the context and original aspect ratio of the object is the key
-def resize_and_pad(image: MatLike, target_size: tuple[int, int, int] = (224, 224, 3)):
+def resize_and_pad(
+    image: MatLike,
+    target_size: tuple[int, int, int] = (224, 224, 3),
+    interpolation: int = cv2.INTER_AREA,
+    dst: np.ndarray | None = None,
+):
+    """
+    Fit image into target_size keeping its aspect ratio, padded with black.
+    With dst (a target_size uint8 canvas) the image is resized straight into
+    it, only the padding is cleared.
+    """
     target_height, target_width, dim = target_size
 
     # Compute the scale factor and resize
     scale = min(target_height / image.shape[0], target_width / image.shape[1])
     new_size = (int(image.shape[1] * scale), int(image.shape[0] * scale))
-    resized = cv2.resize(image, new_size, interpolation=cv2.INTER_AREA)
 
     # Compute padding sizes
-    pad_vert = (target_height - resized.shape[0]) / 2
-    pad_horz = (target_width - resized.shape[1]) / 2
+    pad_vert = (target_height - new_size[1]) / 2
+    pad_horz = (target_width - new_size[0]) / 2
     pad_t = int(np.floor(pad_vert))
     pad_b = int(np.ceil(pad_vert))
     pad_l = int(np.floor(pad_horz))
     pad_r = int(np.ceil(pad_horz))
 
+    if dst is not None:
+        bottom, right = target_height - pad_b, target_width - pad_r
+        dst[:pad_t] = 0
+        dst[bottom:] = 0
+        dst[pad_t:bottom, :pad_l] = 0
+        dst[pad_t:bottom, right:] = 0
+        cv2.resize(
+            image,
+            new_size,
+            dst=dst[pad_t:bottom, pad_l:right],
+            interpolation=interpolation,
+        )
+        return dst
+
+    resized = cv2.resize(image, new_size, interpolation=interpolation)
+
     # Pad the resized image using cv2.copyMakeBorder
     padded = cv2.copyMakeBorder(
         resized,
@@ -35,11 +60,57 @@ def resize_and_pad(image: MatLike, target_size: tuple[int, int, int] = (224, 224
     return padded
 
 
-def resize(image: MatLike, target_size: tuple[int, int] = (224, 224)):
-    resized_image = cv2.resize(image, target_size, interpolation=cv2.INTER_AREA)
+def resize(
+    image: MatLike,
+    target_size: tuple[int, int] = (224, 224),
+    interpolation: int = cv2.INTER_AREA,
+    dst: np.ndarray | None = None,
+):
+    # NOTE: target_size is (width, height) like cv2.resize
+    resized_image = cv2.resize(image, target_size, dst=dst, interpolation=interpolation)
     return resized_image
 
 
+def center_crop(
+    image: MatLike, size: tuple[int, int] = (224, 224), dst: np.ndarray | None = None
+):
+    """
+    Centered (height, width) region of image, a view without copy. A side of
+    image shorter than size is padded with black (into dst when given), the
+    output always has the requested size.
+    """
+    height, width = size
+    top = max(0, (image.shape[0] - height) // 2)
+    left = max(0, (image.shape[1] - width) // 2)
+    cropped = image[top : top + height, left : left + width]
+    if cropped.shape[:2] == (height, width):
+        return cropped
+    if dst is None:
+        dst = np.empty((height, width, *image.shape[2:]), dtype=image.dtype)
+    dst[:] = 0
+    pad_top = (height - cropped.shape[0]) // 2
+    pad_left = (width - cropped.shape[1]) // 2
+    dst[
+        pad_top : pad_top + cropped.shape[0], pad_left : pad_left + cropped.shape[1]
+    ] = cropped
+    return dst
+
+
+def convert_color(image: MatLike, code: int, dst: np.ndarray | None = None):
+    return cv2.cvtColor(image, code, dst=dst)
+
+
+def encode(image: MatLike, image_format: str = "raw", quality: int = 90) -> bytes:
+    """raw: the uint8 pixels as is, jpeg or png: a compressed image."""
+    if image_format == "raw":
+        return image.tobytes()
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if image_format == "jpeg" else []
+    ok, encoded = cv2.imencode(f".{image_format}", image, params)
+    if not ok:
+        raise ValueError(f"Could not encode the image as {image_format}")
+    return encoded.tobytes()
+
+
 # def resize_and_pad(image: MatLike, target_size: tuple[int, int, int] = (32, 32, 3)):
 #     target_height, target_width, dim = target_size
 #
@@ -67,6 +138,77 @@ def resize(image: MatLike, target_size: tuple[int, int] = (224, 224)):
 #     return padded
 
 
+# cv2.imdecode flags decoding a JPEG at 1/factor of its size, libjpeg scales
+# in the DCT domain so most of the decoding work is skipped
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# Start of frame markers, the ones carrying the image size
+_JPEG_SOF_MARKERS = {0xC0 + i for i in range(16)} - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_size(data: bytes) -> tuple[int, int] | None:
+    """(height, width) from the JPEG header, None if data isn't a JPEG."""
+    if data[:2] != b"\xff\xd8":
+        return None
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height = int.from_bytes(data[offset + 5 : offset + 7], "big")
+            width = int.from_bytes(data[offset + 7 : offset + 9], "big")
+            return height, width
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Markers without a segment
+            offset += 2
+            continue
+        offset += 2 + int.from_bytes(data[offset + 2 : offset + 4], "big")
+    return None
+
+
+def reduced_decode_factor(
+    size: tuple[int, int], target_size: tuple[int, int] = (224, 224)
+) -> int:
+    """
+    Largest DCT downscale factor (1, 2, 4 or 8) whose output still covers
+    target_size, in either orientation since the EXIF rotation applies after
+    decoding. libjpeg rounds the scaled dimensions up.
+    """
+    height, width = size
+    for factor in (8, 4, 2):
+        scaled = (-(-height // factor), -(-width // factor))
+        if min(scaled) >= max(target_size[:2]):
+            return factor
+    return 1
+
+
+def decode_image(
+    data: bytes, target_size: tuple[int, int] | None = (224, 224)
+) -> tuple[MatLike | None, int]:
+    """
+    BGR image decoded from data, and the factor it was reduced by. JPEGs are
+    decoded at the smallest scale still covering target_size, full
+    resolution when target_size is None or for the other formats.
+    """
+    factor = 1
+    if target_size is not None:
+        size = jpeg_size(data)
+        if size is not None:
+            factor = reduced_decode_factor(size, target_size)
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), REDUCED_DECODE_FLAGS[factor])
+    return image, factor
+
+
 def say_hello():
     print("Hello from image processing functions file")
 
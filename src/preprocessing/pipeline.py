@@ -0,0 +1,358 @@
+"""
+Config-driven preprocessing pipeline.
+
+`processing.pipeline` in preprocessing_config.yaml lists the stages applied
+to every upload, each a registered function of image_processing_functions.py
+with its parameters:
+
+    pipeline:
+      - decode: {reduced_resolution: true}
+      - convert_color: {code: BGR2RGB}
+      - resize_and_pad: {target_size: [224, 224], interpolation: area}
+      - encode: {format: raw}
+
+compile_pipeline() validates the stages once at startup and fuses them into a
+plan: a channel swap runs after the resize instead of on the full frame, the
+decoder reduces JPEGs to the size the first resize needs (not ahead of a
+crop, which depends on the frame size), and every
+stage writes into buffers preallocated per output shape, the
+`buffer_shapes` most recent ones (the common camera resolutions) are kept.
+
+One decode can feed several output sizes (the input sizes of the ensemble
+models), the geometric stages are then scaled for each of them.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+
+import cv2
+import numpy as np
+from image_processing_functions import (
+    center_crop,
+    convert_color,
+    decode_image,
+    encode,
+    resize,
+    resize_and_pad,
+)
+from numpy.typing import NDArray
+
+INTERPOLATIONS = {
+    "area": cv2.INTER_AREA,
+    "linear": cv2.INTER_LINEAR,
+    "cubic": cv2.INTER_CUBIC,
+    "nearest": cv2.INTER_NEAREST,
+}
+COLOR_CONVERSIONS = {
+    "BGR2RGB": cv2.COLOR_BGR2RGB,
+    "RGB2BGR": cv2.COLOR_RGB2BGR,
+}
+# Conversions that only reorder the channels, they commute with the
+# geometric stages (and with a black padding)
+CHANNEL_SWAPS = {"BGR2RGB", "RGB2BGR"}
+# Stages whose output depends on the frame size (a crop of a reduced frame
+# covers a wider field of view), the decoder can't reduce ahead of them
+SIZE_DEPENDENT_STAGES = {"center_crop"}
+ENCODE_FORMATS = ("raw", "jpeg", "png")
+
+
+class Buffers:
+    """Per-thread output arrays by (stage, shape), the most recent shapes kept."""
+
+    def __init__(self, max_shapes: int = 4):
+        self.max_shapes = max_shapes
+        self._local = threading.local()
+
+    def get(self, stage: int, shape: tuple[int, ...]) -> NDArray:
+        cache = getattr(self._local, "cache", None)
+        if cache is None:
+            cache = self._local.cache = OrderedDict()
+        key = (stage, shape)
+        buffer = cache.get(key)
+        if buffer is None:
+            buffer = cache[key] = np.zeros(shape, dtype=np.uint8)
+            if len(cache) > self.max_shapes:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return buffer
+
+
+# A stage factory takes the stage index and parameters, it returns the stage
+# and the (height, width) it outputs, None when it keeps the frame size
+Stage = Callable[[NDArray, Buffers], NDArray]
+
+
+def _interpolation(name: str) -> int:
+    if name not in INTERPOLATIONS:
+        raise ValueError(
+            f"Unknown interpolation {name}, expected one of {list(INTERPOLATIONS)}"
+        )
+    return INTERPOLATIONS[name]
+
+
+def _target_size(target_size) -> tuple[int, int]:
+    height, width = (int(dim) for dim in list(target_size)[:2])
+    return height, width
+
+
+def _resize_stage(index, target_size=(224, 224), interpolation="area"):
+    height, width = _target_size(target_size)
+    flag = _interpolation(interpolation)
+
+    def stage(image, buffers):
+        if image.shape[:2] == (height, width):
+            return image
+        dst = buffers.get(index, (height, width, *image.shape[2:]))
+        return resize(image, (width, height), interpolation=flag, dst=dst)
+
+    return stage, (height, width)
+
+
+def _resize_and_pad_stage(index, target_size=(224, 224), interpolation="area"):
+    height, width = _target_size(target_size)
+    flag = _interpolation(interpolation)
+
+    def stage(image, buffers):
+        dst = buffers.get(index, (height, width, *image.shape[2:]))
+        return resize_and_pad(image, (height, width, 3), interpolation=flag, dst=dst)
+
+    return stage, (height, width)
+
+
+def _center_crop_stage(index, size=(224, 224)):
+    height, width = _target_size(size)
+
+    def stage(image, buffers):
+        if image.shape[0] >= height and image.shape[1] >= width:
+            return center_crop(image, (height, width))
+        # Smaller than the crop, padded into a buffer
+        dst = buffers.get(index, (height, width, *image.shape[2:]))
+        return center_crop(image, (height, width), dst=dst)
+
+    return stage, (height, width)
+
+
+def _convert_color_stage(index, code="BGR2RGB"):
+    if code not in COLOR_CONVERSIONS:
+        raise ValueError(
+            f"Unknown colour conversion {code}, expected one of {list(COLOR_CONVERSIONS)}"
+        )
+    flag = COLOR_CONVERSIONS[code]
+
+    def stage(image, buffers):
+        return convert_color(image, flag, dst=buffers.get(index, image.shape))
+
+    return stage, None
+
+
+STAGES = {
+    "resize": _resize_stage,
+    "resize_and_pad": _resize_and_pad_stage,
+    "center_crop": _center_crop_stage,
+    "convert_color": _convert_color_stage,
+}
+
+
+def _parse_step(step) -> tuple[str, dict]:
+    if isinstance(step, str):
+        return step, {}
+    if not isinstance(step, dict) or len(step) != 1:
+        raise ValueError(
+            f"A pipeline stage is a name or a {{name: params}}, got {step}"
+        )
+    ((name, params),) = step.items()
+    return name, dict(params or {})
+
+
+# Parameter holding the (height, width) of each geometric stage
+GEOMETRIC_PARAMS = {
+    "resize": "target_size",
+    "resize_and_pad": "target_size",
+    "center_crop": "size",
+}
+_DEFAULT_SIZE = (224, 224)
+
+
+def _scaled_steps(
+    transforms: list[tuple[str, dict]], scale: tuple[float, float]
+) -> list[tuple[str, dict]]:
+    """transforms with the size of every geometric stage scaled by scale."""
+    scaled = []
+    for name, params in transforms:
+        if name in GEOMETRIC_PARAMS:
+            key = GEOMETRIC_PARAMS[name]
+            height, width = _target_size(params.get(key, _DEFAULT_SIZE))
+            params = {
+                **params,
+                key: (round(height * scale[0]), round(width * scale[1])),
+            }
+        scaled.append((name, params))
+    return scaled
+
+
+class Pipeline:
+    def __init__(
+        self,
+        transforms: list[tuple[str, dict]],
+        reduced_resolution: bool = True,
+        image_format: str = "raw",
+        quality: int = 90,
+        buffer_shapes: int = 4,
+    ):
+        self.transforms = transforms
+        self.reduced_resolution = reduced_resolution
+        self.image_format = image_format
+        self.quality = quality
+        self.buffer_shapes = buffer_shapes
+        self.buffers = Buffers(buffer_shapes * max(1, len(transforms)))
+        # Compiled stages and the size the decoder has to cover, by output size
+        self._variants: dict[tuple[int, int] | None, tuple[list[Stage], tuple]] = {}
+        stages, sizes, cover = self._compile(transforms)
+        self.output_size = sizes[-1] if sizes else None
+        self._variants[self.output_size] = (stages, cover)
+
+    @staticmethod
+    def _compile(transforms):
+        """
+        Stages, their output sizes and the size the decoder has to cover:
+        the first resize, None (full resolution) when a crop comes first.
+        """
+        stages, sizes = [], []
+        cover = None
+        for index, (name, params) in enumerate(transforms):
+            stage, size = STAGES[name](index, **params)
+            stages.append(stage)
+            if size is not None:
+                if not sizes and name not in SIZE_DEPENDENT_STAGES:
+                    cover = size
+                sizes.append(size)
+        return stages, sizes, cover
+
+    def variant(self, size: tuple[int, int] | None) -> tuple[list[Stage], tuple | None]:
+        """
+        Stages producing a size output, the geometric stages scaled from the
+        configured output size (e.g. resize 256 + crop 224 gives resize 342 +
+        crop 299 for 299). Compiled on first use.
+        """
+        if size not in self._variants:
+            if self.output_size is None:
+                raise ValueError("The pipeline has no resize or crop stage to scale")
+            scale = (size[0] / self.output_size[0], size[1] / self.output_size[1])
+            stages, _, cover = self._compile(_scaled_steps(self.transforms, scale))
+            self._variants[size] = (stages, cover)
+            self.buffers.max_shapes = (
+                self.buffer_shapes * max(1, len(stages)) * len(self._variants)
+            )
+        return self._variants[size]
+
+    def decode_size(self, sizes: list) -> tuple[int, int] | None:
+        """Size the decoder has to cover for sizes, None for full resolution."""
+        covers = [self.variant(size)[1] for size in sizes]
+        if not self.reduced_resolution or None in covers:
+            return None
+        return max(covers, key=max)
+
+    def __call__(
+        self, data: bytes, sizes: list[tuple[int, int]] | None = None
+    ) -> tuple[list[bytes] | None, int, float]:
+        """
+        Encoded output of the upload data for each of sizes (the configured
+        output size when None), all from a single decode. None when data
+        can't be decoded, with the decoding reduction factor and the decoding
+        time in ms.
+        """
+        sizes = sizes or [self.output_size]
+        start = time.perf_counter()
+        image, factor = decode_image(data, self.decode_size(sizes))
+        decode_ms = (time.perf_counter() - start) * 1000
+        if image is None:
+            return None, factor, decode_ms
+        outputs = []
+        for size in sizes:
+            output = image
+            for stage in self.variant(size)[0]:
+                output = stage(output, self.buffers)
+            # NOTE: encode copies out of the reused buffers
+            outputs.append(encode(output, self.image_format, self.quality))
+        return outputs, factor, decode_ms
+
+
+def compile_pipeline(steps: list, buffer_shapes: int = 4) -> Pipeline:
+    """Validate the configured stages and fuse them into a Pipeline."""
+    parsed = [_parse_step(step) for step in steps]
+    names = [name for name, _ in parsed]
+    if not names or names[0] != "decode":
+        raise ValueError(f"The pipeline has to start with decode, got {names}")
+    if "decode" in names[1:] or "encode" in names[:-1]:
+        raise ValueError(f"decode comes first and encode last, got {names}")
+
+    decode_params = parsed[0][1]
+    encode_params = parsed[-1][1] if names[-1] == "encode" else {}
+    image_format = encode_params.get("format", "raw")
+    if image_format not in ENCODE_FORMATS:
+        raise ValueError(
+            f"Unknown encode format {image_format}, expected one of {ENCODE_FORMATS}"
+        )
+    transforms = parsed[1:-1] if names[-1] == "encode" else parsed[1:]
+    for name, _ in transforms:
+        if name not in STAGES:
+            raise ValueError(
+                f"Unknown pipeline stage {name}, expected one of "
+                f"{['decode', *STAGES, 'encode']}"
+            )
+
+    # Fusion: the channel swaps are per pixel, running them on the resized
+    # frame gives the same output for a fraction of the work
+    if all(
+        name != "convert_color" or params.get("code", "BGR2RGB") in CHANNEL_SWAPS
+        for name, params in transforms
+    ):
+        transforms = [t for t in transforms if t[0] != "convert_color"] + [
+            t for t in transforms if t[0] == "convert_color"
+        ]
+
+    return Pipeline(
+        transforms,
+        reduced_resolution=decode_params.get("reduced_resolution", True),
+        image_format=image_format,
+        quality=int(encode_params.get("quality", 90)),
+        buffer_shapes=buffer_shapes,
+    )
+
+
+def default_steps(image_processing: dict | None) -> list:
+    """Stages equivalent to the former `image_processing` section."""
+    image_processing = image_processing or {}
+    target_dim = image_processing.get("target_dim", [224, 224, 3])
+    if isinstance(target_dim, str):
+        # Written as a tuple, e.g. (224,224,3)
+        target_dim = [int(dim) for dim in target_dim.strip("()[] ").split(",")]
+    return [
+        {"decode": {"reduced_resolution": True}},
+        {"convert_color": {"code": "BGR2RGB"}},
+        {image_processing.get("func_name", "resize"): {"target_size": target_dim}},
+        {"encode": {"format": "raw"}},
+    ]
+
+
+# The plan of this process, built by configure() at startup and in every
+# worker process of the executor
+_pipeline: Pipeline | None = None
+
+
+def configure(steps: list, buffer_shapes: int = 4) -> Pipeline:
+    global _pipeline
+    _pipeline = compile_pipeline(steps, buffer_shapes)
+    return _pipeline
+
+
+def run(
+    data: bytes, sizes: list[tuple[int, int]] | None = None
+) -> tuple[list[bytes] | None, int, float]:
+    """The configured pipeline applied to data, see Pipeline.__call__."""
+    if _pipeline is None:
+        raise RuntimeError("pipeline.configure() wasn't called in this process")
+    return _pipeline(data, sizes)
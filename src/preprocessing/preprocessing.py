@@ -2,16 +2,24 @@ import asyncio
 import logging
 import os
 import sys
+from contextlib import asynccontextmanager
 from uuid import uuid4
 
 import aiohttp
-import cv2
-import numpy as np
+import pipeline
+from batch_upload import ARCHIVE_TYPES, BatchUploadError, read_archive
 from fastapi import FastAPI, HTTPException, Request, UploadFile, status
 from fastapi.responses import JSONResponse
-from image_processing_functions import resize
+from image_executor import ExecutorBusyError, ImageExecutor
+from opentelemetry import metrics
 
-from util.utils import load_config, setup_otel
+from util.tensor_protocol import (
+    IMAGE_SIZES_HEADER,
+    INPUT_SIZES_HEADER,
+    format_sizes,
+    parse_sizes,
+)
+from util.utils import create_client_session, load_config, setup_otel
 
 SERVICE_NAME = os.environ.get("SERVICE_NAME", "ensemble")
 
@@ -24,8 +32,24 @@ if os.environ.get("DOCKER"):
 if os.environ.get("OPENZITI"):
     ENSEMBLE_SERVICE_URL = "http://ensemble.miniziti.private:5011/ensemble_service"
 
+ENSEMBLE_BATCH_URL = f"{ENSEMBLE_SERVICE_URL}/batch"
+
 
 setup_otel(SERVICE_NAME)
+meter = metrics.get_meter(SERVICE_NAME)
+decoded_images = meter.create_counter(
+    "preprocessing.decode.images",
+    description="Decoded uploads by DCT reduction factor (1 is full resolution)",
+)
+decode_duration = meter.create_histogram(
+    "preprocessing.decode.duration",
+    unit="ms",
+    description="Decoding time of an upload by DCT reduction factor",
+)
+batch_images = meter.create_histogram(
+    "preprocessing.batch.images",
+    description="Images per /preprocessing/batch request",
+)
 
 try:
     config_file = "preprocessing_config.yaml"
@@ -35,6 +59,37 @@ except Exception as e:
     sys.exit(1)
 assert config is not None
 
+# NOTE: compiled once here (and in every worker process of the executor), a
+# broken pipeline configuration stops the service at startup
+processing_config = config.get("processing", {})
+pipeline_steps = processing_config.get("pipeline") or pipeline.default_steps(
+    processing_config.get("image_processing")
+)
+buffer_shapes = processing_config.get("buffer_shapes", 4)
+try:
+    image_pipeline = pipeline.configure(pipeline_steps, buffer_shapes)
+except (TypeError, ValueError) as e:
+    logging.error(f"Invalid processing.pipeline {pipeline_steps}: {e}")
+    sys.exit(1)
+logging.info(
+    f"Preprocessing pipeline {pipeline_steps}, output {image_pipeline.output_size}"
+)
+
+# NOTE: one frame per input size of the ensemble models, all from one decode.
+# With `ensemble` the sizes follow the X-Input-Sizes header of the ensemble
+# responses (after a /change_config too), starting from the pipeline output
+output_sizes_config = processing_config.get("output_sizes", "ensemble")
+follow_ensemble_sizes = output_sizes_config == "ensemble"
+output_sizes = (
+    [image_pipeline.output_size]
+    if follow_ensemble_sizes
+    else [tuple(size) for size in output_sizes_config]
+)
+
+batch_config = config.get("batch_upload", {})
+max_batch_images = batch_config.get("max_images", 64)
+max_image_bytes = batch_config.get("max_image_bytes", 20 * 1024 * 1024)
+
 
 accepted_file_types = [
     "image/png",
@@ -52,7 +107,33 @@ accepted_file_types = [
 ]
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled session for the whole app, connections to the ensemble
+    # service are kept alive across uploads
+    app.state.http_session = create_client_session(
+        SERVICE_NAME, config.get("http_client")
+    )
+    # Decoding and resizing run off the event loop, so a large upload
+    # doesn't stall the others
+    executor_config = processing_config.get("executor", {})
+    app.state.image_executor = ImageExecutor(
+        executor_config.get("type", "process"),
+        workers=executor_config.get("workers", 0),
+        max_queued=executor_config.get("max_queued", 64),
+        initializer=pipeline.configure,
+        initargs=(pipeline_steps, buffer_shapes),
+    )
+    try:
+        app.state.image_executor.start()
+        app.state.output_sizes = output_sizes
+        yield
+    finally:
+        app.state.image_executor.shutdown()
+        await app.state.http_session.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/test/")
@@ -78,49 +159,70 @@ def validate_image_type(content_type: str | None):
         )
 
 
-@app.post("/preprocessing")
-async def processing_image(file: UploadFile, request: Request):
-    logging.debug(request.headers)
-    validate_image_type(file.content_type)
+def update_output_sizes(app: FastAPI, input_sizes: str | None):
+    try:
+        sizes = parse_sizes(input_sizes)
+    except ValueError as e:
+        logging.warning(f"Ignoring the input sizes {input_sizes} of the ensemble: {e}")
+        return
+    if sizes and sizes != app.state.output_sizes:
+        logging.info(f"Sending frames of {sizes} to the ensemble")
+        app.state.output_sizes = sizes
+
+
+def executor_busy(e: ExecutorBusyError) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
 
-    contents = await file.read()
-    np_array = np.frombuffer(contents, np.uint8)
-    image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
-    # NOTE: cv2 and Pillow has different color channel layout
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    shape = image.shape
-    if shape != (224, 224, 3):
-        processed_image = resize(image)
-    else:
-        processed_image = image
-
-    image_bytes = processed_image.tobytes()
-    request_id = str(uuid4())
 
-    headers = {
+def record_decode(factor: int, decode_ms: float):
+    decode_duration.record(decode_ms, {"factor": factor})
+    decoded_images.add(1, {"factor": factor})
+
+
+def ensemble_headers(request: Request, body: bytes, sizes: list) -> dict:
+    return {
         "Timestamp": request.headers.get("Timestamp"),
         "Content-Type": "application/octet-stream",
-        "Content-Length": str(len(image_bytes)),
+        "Content-Length": str(len(body)),
+        IMAGE_SIZES_HEADER: format_sizes(sizes),
     }
 
+
+async def forward_to_ensemble(
+    request: Request, url: str, body: bytes, headers: dict, params
+):
+    """POST body to the ensemble, HTTPException unless it was accepted."""
     try:
-        async with aiohttp.ClientSession(
-            timeout=aiohttp.ClientTimeout(total=10)
-        ) as session:
-            logging.debug(ENSEMBLE_SERVICE_URL)
-            async with session.post(
-                headers=headers,
-                url=ENSEMBLE_SERVICE_URL,
-                data=image_bytes,
-                params={"request_id": request_id},
-            ) as response:
-                if response.status != 200:
-                    raise HTTPException(
-                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                        detail=f"Failed to send image to ensemble service. Status code: {response.status}",
-                    )
-                _ = await response.json()
-        return "File accepted"
+        logging.debug(url)
+        async with request.app.state.http_session.post(
+            headers=headers,
+            url=url,
+            data=body,
+            params=params,
+        ) as response:
+            if response.status == status.HTTP_429_TOO_MANY_REQUESTS:
+                # Ensemble overloaded, let the client back off too
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Ensemble service overloaded, retry later.",
+                    headers={"Retry-After": response.headers.get("Retry-After", "1")},
+                )
+            if response.status != 200:
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail=f"Failed to send image to ensemble service. Status code: {response.status}",
+                )
+            _ = await response.json()
+            if follow_ensemble_sizes:
+                update_output_sizes(
+                    request.app, response.headers.get(INPUT_SIZES_HEADER)
+                )
+    except HTTPException:
+        raise
     except aiohttp.ClientError as e:
         logging.error(f"Client error: {e}")
         raise HTTPException(
@@ -141,6 +243,133 @@ async def processing_image(file: UploadFile, request: Request):
         )
 
 
+@app.post("/preprocessing")
+async def processing_image(file: UploadFile, request: Request):
+    logging.debug(request.headers)
+    validate_image_type(file.content_type)
+
+    contents = await file.read()
+    sizes = request.app.state.output_sizes
+    try:
+        images, factor, decode_ms = await request.app.state.image_executor.run(
+            pipeline.run, contents, sizes
+        )
+    except ExecutorBusyError as e:
+        raise executor_busy(e)
+    record_decode(factor, decode_ms)
+    if images is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="UploadFile could not be decoded as an image",
+        )
+    image_bytes = b"".join(images)
+    request_id = str(uuid4())
+
+    headers = ensemble_headers(request, image_bytes, sizes)
+    await forward_to_ensemble(
+        request, ENSEMBLE_SERVICE_URL, image_bytes, headers, {"request_id": request_id}
+    )
+    return "File accepted"
+
+
+async def read_batch(request: Request) -> list[tuple[str, bytes]]:
+    """(name, data) of the images of a batch request, see batch_upload.py."""
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type in ARCHIVE_TYPES:
+        return read_archive(
+            await request.body(), content_type, max_batch_images, max_image_bytes
+        )
+    if content_type != "multipart/form-data":
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Expected multipart/form-data or one of {list(ARCHIVE_TYPES)}",
+        )
+    uploads = []
+    async with request.form(max_files=max_batch_images) as form:
+        for _, upload in form.multi_items():
+            if isinstance(upload, str):
+                continue
+            remaining = max_batch_images - len(uploads)
+            if upload.content_type in ARCHIVE_TYPES:
+                uploads.extend(
+                    read_archive(
+                        await upload.read(),
+                        upload.content_type,
+                        remaining,
+                        max_image_bytes,
+                    )
+                )
+                continue
+            validate_image_type(upload.content_type)
+            if remaining == 0:
+                raise BatchUploadError(
+                    f"More than {max_batch_images} images in a batch", status_code=413
+                )
+            if upload.size is not None and upload.size > max_image_bytes:
+                raise BatchUploadError(
+                    f"{upload.filename} is larger than {max_image_bytes} bytes",
+                    status_code=413,
+                )
+            uploads.append((upload.filename, await upload.read()))
+    return uploads
+
+
+@app.post("/preprocessing/batch")
+async def processing_batch(request: Request):
+    """
+    Many images in one request, as multi-file multipart or a tar/zip archive.
+    They are decoded in parallel and forwarded to the ensemble in one body,
+    the response has a request_id per image (an error when it couldn't be
+    decoded), in upload order.
+    """
+    logging.debug(request.headers)
+    try:
+        uploads = await read_batch(request)
+    except BatchUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    if not uploads:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="No image in the batch"
+        )
+    batch_images.record(len(uploads))
+
+    sizes = request.app.state.output_sizes
+    try:
+        results = await request.app.state.image_executor.map(
+            pipeline.run, [(data, sizes) for _, data in uploads]
+        )
+    except ExecutorBusyError as e:
+        raise executor_busy(e)
+
+    entries, frames, request_ids = [], [], []
+    for (name, _), (images, factor, decode_ms) in zip(uploads, results, strict=False):
+        record_decode(factor, decode_ms)
+        if images is None:
+            entries.append({"filename": name, "error": "Could not be decoded"})
+            continue
+        request_id = str(uuid4())
+        request_ids.append(request_id)
+        frames.extend(images)
+        entries.append({"filename": name, "request_id": request_id})
+    if not request_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="None of the images could be decoded",
+        )
+
+    # NOTE: one body for the whole batch, the frames of each image back to
+    # back, one request_id parameter per image in the same order
+    body = b"".join(frames)
+    await forward_to_ensemble(
+        request,
+        ENSEMBLE_BATCH_URL,
+        body,
+        ensemble_headers(request, body, sizes),
+        [("request_id", request_id) for request_id in request_ids],
+    )
+    return JSONResponse(content={"images": entries}, status_code=200)
+
+
 if os.environ.get("MANUAL_TRACING"):
     from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
     from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
@@ -0,0 +1,88 @@
+"""
+Throughput of the preprocessing image work per executor type.
+
+Runs the preprocessing pipeline of preprocessing_config.yaml on synthetic
+JPEG frames through an ImageExecutor from one event loop, as the
+/preprocessing handler does, and prints the uploads/s overall and per core
+used.
+
+    python preprocessing_benchmark.py --resolution 1920x1080 --workers 4
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+import cv2
+import numpy as np
+import pipeline
+from image_executor import ImageExecutor
+
+from util.utils import load_config
+
+
+def synthetic_jpeg(width: int, height: int, seed: int) -> bytes:
+    # Smooth noise compresses like a camera frame, unlike white noise
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+    frame = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    return cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+async def measure(executor: ImageExecutor, uploads: list[bytes], concurrency: int):
+    pending = iter(uploads)
+
+    async def client():
+        for data in pending:
+            await executor.run(pipeline.run, data)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return len(uploads) / (time.perf_counter() - start)
+
+
+async def main(args):
+    width, height = (int(v) for v in args.resolution.split("x"))
+    frames = [synthetic_jpeg(width, height, seed) for seed in range(8)]
+    uploads = [frames[i % len(frames)] for i in range(args.uploads)]
+    workers = args.workers or len(os.sched_getaffinity(0))
+    processing_config = load_config(file_path=args.config)["processing"]
+    steps = processing_config["pipeline"]
+    pipeline.configure(steps)
+
+    print(f"{len(uploads)} uploads of {width}x{height}, concurrency {args.concurrency}")
+    print(f"{'executor':<8} {'workers':>7} {'uploads/s':>10} {'per core':>9}")
+    for executor_type in args.executors:
+        executor = ImageExecutor(
+            executor_type,
+            workers=workers,
+            max_queued=args.concurrency,
+            initializer=pipeline.configure,
+            initargs=(steps,),
+        )
+        executor.start()
+        try:
+            # Warm up, e.g. start the worker processes
+            await measure(executor, uploads[: workers * 2], args.concurrency)
+            throughput = await measure(executor, uploads, args.concurrency)
+        finally:
+            executor.shutdown()
+        cores = 1 if executor_type == "inline" else executor.workers
+        print(
+            f"{executor_type:<8} {cores:>7} {throughput:>10.1f} "
+            f"{throughput / cores:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="preprocessing_config.yaml")
+    parser.add_argument("--resolution", default="1920x1080")
+    parser.add_argument("--uploads", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument(
+        "--executors", nargs="+", default=["inline", "thread", "process"]
+    )
+    asyncio.run(main(args=parser.parse_args()))
@@ -0,0 +1,97 @@
+"""
+Microbenchmark of util.preprocessing.preprocess_input.
+
+Compares the fused kernel, with and without a preallocated `out` buffer,
+against the previous keras-style implementation for every mode on a single
+HWC image and a batched NHWC tensor, and checks that the results match.
+
+    uv run --package=util python src/util/benchmark/preprocessing_benchmark.py
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+
+from util.preprocessing import preprocess_input
+
+
+def reference_preprocess_input(x, mode):
+    """Previous implementation (channels_last only), kept as the baseline."""
+    x = x.astype(np.float32, copy=False)
+    if mode == "raw":
+        return x
+    if mode == "tf":
+        x = x / 127.5
+        x -= 1.0
+        return x
+    elif mode == "torch":
+        x /= 255.0
+        mean = [0.485, 0.456, 0.406]
+        std = [0.229, 0.224, 0.225]
+    else:
+        x = x[..., ::-1]
+        mean = [103.939, 116.779, 123.68]
+        std = None
+    x[..., 0] -= mean[0]
+    x[..., 1] -= mean[1]
+    x[..., 2] -= mean[2]
+    if std is not None:
+        x[..., 0] /= std[0]
+        x[..., 1] /= std[1]
+        x[..., 2] /= std[2]
+    return x
+
+
+def best_time_us(func, number: int, repeat: int):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=224, help="image height/width")
+    parser.add_argument("--batch", type=int, default=16, help="NHWC batch size")
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shapes = [
+        (args.size, args.size, 3),
+        (args.batch, args.size, args.size, 3),
+    ]
+
+    print(
+        f"{'mode':<6} {'shape':<20} {'reference':>12} {'fused':>12} "
+        f"{'fused+out':>12} {'speedup':>8}"
+    )
+    for shape in shapes:
+        image = rng.integers(0, 256, size=shape, dtype=np.uint8)
+        out = np.empty(shape, dtype=np.float32)
+        number = max(1, 200 // (shape[0] if len(shape) == 4 else 1))
+
+        for mode in ["tf", "torch", "caffe", "raw"]:
+            expected = reference_preprocess_input(image.copy(), mode)
+            actual = preprocess_input(image, mode=mode, out=out)
+            np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-4)
+
+            # The reference mutates its input, give it a fresh copy like the
+            # inference service did
+            reference = best_time_us(
+                lambda: reference_preprocess_input(image.copy(), mode),  # noqa: B023
+                number,
+                args.repeat,
+            )
+            fused = best_time_us(
+                lambda: preprocess_input(image, mode=mode),  # noqa: B023
+                number,
+                args.repeat,
+            )
+            fused_out = best_time_us(
+                lambda: preprocess_input(image, mode=mode, out=out),  # noqa: B023
+                number,
+                args.repeat,
+            )
+            print(
+                f"{mode:<6} {shape!s:<20} {reference:>10.0f}us {fused:>10.0f}us "
+                f"{fused_out:>10.0f}us {reference / fused_out:>7.2f}x"
+            )
@@ -1,13 +1,57 @@
+import functools
+
 import numpy as np
 
+# Each mode written as `out[..., c] = x[..., order[c]] * scale[c] + offset[c]`
+_TORCH_MEAN = np.array([0.485, 0.456, 0.406])
+_TORCH_STD = np.array([0.229, 0.224, 0.225])
+_MODE_CONSTANTS = {
+    # mode: (flip RGB->BGR, scale, offset)
+    "tf": (False, np.full(3, 1 / 127.5), np.full(3, -1.0)),
+    "torch": (False, 1 / (255.0 * _TORCH_STD), -_TORCH_MEAN / _TORCH_STD),
+    "caffe": (True, np.ones(3), -np.array([103.939, 116.779, 123.68])),
+    "raw": (False, np.ones(3), np.zeros(3)),
+}
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_mode(mode: str, data_format: str, width: int):
+    """Turn the constants of a mode into operands of single broadcast passes.
+
+    Constants shared by all channels become float32 scalars. Per-channel
+    constants are tiled along a whole image row for channels_last, so the
+    ufunc inner loop runs over `width * 3` contiguous values instead of 3.
+
+    Returns:
+        Tuple of (flip, scale, offset), scale/offset are None when they are a no-op.
+    """
+    flip, scale, offset = _MODE_CONSTANTS[mode]
+
+    def operand(values: np.ndarray, neutral: float):
+        if np.all(values == neutral):
+            return None
+        if np.all(values == values[0]):
+            return np.float32(values[0])
+        if data_format == "channels_first":
+            return values.astype(np.float32).reshape(3, 1, 1)
+        return np.tile(values.astype(np.float32), width)
+
+    return flip, operand(scale, 1.0), operand(offset, 0.0)
+
+
+def _channel(x: np.ndarray, index: int, data_format: str):
+    if data_format == "channels_first":
+        return x[..., index, :, :]
+    return x[..., index]
+
 
-def _preprocess_numpy_input(x, data_format, mode):
-    """Preprocesses a NumPy array encoding a batch of images.
+def _preprocess_numpy_input(x, data_format, mode, out):
+    """Preprocesses a NumPy array encoding a single image or a batch of images.
 
     Args:
       x: Input array, 3D or 4D.
       data_format: Data format of the image array.
-      mode: One of "caffe", "tf" or "torch".
+      mode: One of "caffe", "tf", "torch" or "raw".
         - caffe: will convert the images from RGB to BGR,
             then will zero-center each color channel with
             respect to the ImageNet dataset,
@@ -17,75 +61,50 @@ def _preprocess_numpy_input(x, data_format, mode):
         - torch: will scale pixels between 0 and 1 and then
             will normalize each channel with respect to the
             ImageNet dataset.
+        - raw: only converts to float32.
+      out: float32 array with the shape of `x` receiving the result.
 
     Returns:
-        Preprocessed Numpy array.
+        Preprocessed Numpy array, `out`.
     """
-    # if not issubclass(x.dtype.type, np.floating):
-    #     x = x.astype(np.float32, copy=False)
-
-    if mode == "tf":
-        x = x / 127.5
-        x -= 1.0
-        return x
-    elif mode == "torch":
-        x /= 255.0
-        mean = [0.485, 0.456, 0.406]
-        std = [0.229, 0.224, 0.225]
-    else:
-        if data_format == "channels_first":
-            # 'RGB'->'BGR'
-            if len(x.shape) == 3:
-                x = x[::-1, ...]
-            else:
-                x = x[:, ::-1, ...]
-        else:
-            # 'RGB'->'BGR'
-            x = x[..., ::-1]
-        mean = [103.939, 116.779, 123.68]
-        std = None
-
-    # Zero-center by mean pixel
-    if data_format == "channels_first":
-        if len(x.shape) == 3:
-            x[0, :, :] -= mean[0]
-            x[1, :, :] -= mean[1]
-            x[2, :, :] -= mean[2]
-            if std is not None:
-                x[0, :, :] /= std[0]
-                x[1, :, :] /= std[1]
-                x[2, :, :] /= std[2]
-        else:
-            x[:, 0, :, :] -= mean[0]
-            x[:, 1, :, :] -= mean[1]
-            x[:, 2, :, :] -= mean[2]
-            if std is not None:
-                x[:, 0, :, :] /= std[0]
-                x[:, 1, :, :] /= std[1]
-                x[:, 2, :, :] /= std[2]
-    else:
-        x[..., 0] -= mean[0]
-        x[..., 1] -= mean[1]
-        x[..., 2] -= mean[2]
-        if std is not None:
-            x[..., 0] /= std[0]
-            x[..., 1] /= std[1]
-            x[..., 2] /= std[2]
-    return x
-
-
-def preprocess_input(x, data_format="channels_last", mode="caffe"):
-    """Preprocesses a tensor or Numpy array encoding a batch of images."""
-
-    if not issubclass(x.dtype.type, np.floating):
-        x = x.astype(np.float32, copy=False)
-
-    if mode == "raw":
-        return x
-
-    if mode not in {"caffe", "tf", "torch"}:
+    width = x.shape[-2] if data_format == "channels_last" else 0
+    flip, scale, offset = _compile_mode(mode, data_format, width)
+
+    if flip:
+        if np.shares_memory(x, out):
+            x = x.copy()
+        for channel in range(3):
+            np.copyto(
+                _channel(out, channel, data_format),
+                _channel(x, 2 - channel, data_format),
+                casting="same_kind",
+            )
+    elif out is not x:
+        np.copyto(out, x, casting="same_kind")
+
+    view = out
+    if isinstance(scale, np.ndarray) or isinstance(offset, np.ndarray):
+        if data_format == "channels_last":
+            # One row per image line so the tiled constants broadcast
+            view = out.reshape(-1, width * 3)
+    if scale is not None:
+        np.multiply(view, scale, out=view)
+    if offset is not None:
+        np.add(view, offset, out=view)
+    return out
+
+
+def preprocess_input(x, data_format="channels_last", mode="caffe", out=None):
+    """Preprocesses a Numpy array encoding an image (HWC) or a batch of images (NHWC).
+
+    The whole mode runs as at most one copy and two in-place broadcast passes
+    over `out`. Pass a preallocated C-contiguous float32 `out` to avoid any
+    allocation, `out=x` for a float32 `x` is allowed. When `out` is None a
+    new float32 array is returned and `x` is left untouched.
+    """
+    if mode not in _MODE_CONSTANTS:
         raise ValueError(
-            "Expected mode to be one of `caffe`, `tf` or `torch`. "
+            "Expected mode to be one of `caffe`, `tf`, `torch` or `raw`. "
             f"Received: mode={mode}"
         )
 
@@ -95,9 +114,15 @@ def preprocess_input(x, data_format="channels_last", mode="caffe"):
             f"`channels_last`. Received: data_format={data_format}"
         )
 
-    if isinstance(x, np.ndarray):
-        return _preprocess_numpy_input(x, data_format=data_format, mode=mode)
-    raise ValueError(
-        "Expected data_format to be one of `channels_first` or "
-        f"`channels_last`. Received: data_format={data_format}"
-    )
+    if not isinstance(x, np.ndarray):
+        raise ValueError(f"Expected a Numpy array. Received: {type(x)}")
+
+    if out is None:
+        out = np.empty(x.shape, dtype=np.float32)
+    elif out.shape != x.shape or out.dtype != np.float32 or not out.flags.c_contiguous:
+        raise ValueError(
+            "Expected out to be a C-contiguous float32 array of shape "
+            f"{x.shape}. Received: shape={out.shape}, dtype={out.dtype}"
+        )
+
+    return _preprocess_numpy_input(x, data_format=data_format, mode=mode, out=out)
@@ -0,0 +1,339 @@
+"""
+Compact binary encoding of model predictions exchanged between services.
+
+Prediction layout (little endian):
+    header      magic "PTNS", version, dtype code, flags, ndim, model id length
+    model id    utf-8, padded to a multiple of 4 bytes
+    shape       ndim x uint32
+    indices     int32 class indices, only when FLAG_INDICES is set (top-k)
+    values      probabilities packed as float16 or float32
+
+Several raw uint8 RGB frames of one image (one per model input size) travel
+as a single body, concatenated in the order of the IMAGE_SIZES_HEADER, e.g.
+`X-Image-Sizes: 224x224,299x299`. A batch body carries the frames of several
+images back to back, in the order of their request ids.
+
+Request layout of the gRPC transport, same conventions:
+    header      magic "PTRQ", version, reply dtype code, flags, ndim, model id length
+    model id    utf-8, padded to a multiple of 4 bytes, empty for the default model
+    top_k       uint32, only when FLAG_TOP_K is set
+    shape       ndim x uint32
+    image       uint8 pixels
+"""
+
+from __future__ import annotations
+
+import math
+import struct
+from dataclasses import dataclass
+
+import numpy as np
+from numpy.typing import NDArray
+
+from util.classes import IMAGENET2012_CLASSES
+
+MEDIA_TYPE = "application/x-prediction-tensor"
+# Unary gRPC method taking an encoded request and replying an encoded prediction
+GRPC_PREDICT_METHOD = "/inference.Inference/Predict"
+
+# Sizes of the frames concatenated in a request body
+IMAGE_SIZES_HEADER = "X-Image-Sizes"
+# Sizes the ensemble wants, sent back to preprocessing with each response
+INPUT_SIZES_HEADER = "X-Input-Sizes"
+# Bounds on the sizes read from a header and on the frames accepted
+MAX_IMAGE_SIZES = 8
+MIN_IMAGE_SIDE = 32
+MAX_IMAGE_SIDE = 1024
+
+_MAGIC = b"PTNS"
+_REQUEST_MAGIC = b"PTRQ"
+_VERSION = 1
+_HEADER = struct.Struct("<4sBBBBH")
+FLAG_INDICES = 0x01
+FLAG_TOP_K = 0x01
+
+_DTYPE_CODES = {np.dtype(np.float16): 1, np.dtype(np.float32): 2}
+_CODE_DTYPES = {code: dtype for dtype, code in _DTYPE_CODES.items()}
+
+_KEY_LIST = list(IMAGENET2012_CLASSES.keys())
+
+
+def _pad(length: int) -> int:
+    return -length % 4
+
+
+@dataclass
+class TensorPrediction:
+    model_id: str
+    values: NDArray
+    # Class index of each value, None when values cover every class
+    indices: NDArray | None = None
+
+    def probabilities(self, num_classes: int = len(_KEY_LIST)) -> NDArray:
+        """Dense float32 probability vector, classes outside the top-k are 0."""
+        if self.indices is None:
+            return self.values.astype(np.float32)
+        dense = np.zeros((*self.values.shape[:-1], num_classes), dtype=np.float32)
+        np.put_along_axis(dense, self.indices.astype(np.intp), self.values, axis=-1)
+        return dense
+
+    def top1(self) -> tuple[str, float]:
+        """Same [synset, probability] pair the JSON response carries."""
+        position = int(np.argmax(self.values))
+        class_index = position if self.indices is None else int(self.indices[position])
+        return _KEY_LIST[class_index], float(self.values[position])
+
+
+def encode_prediction(
+    model_id: str,
+    probabilities: NDArray,
+    top_k: int | None = None,
+    dtype: type = np.float16,
+) -> bytes:
+    """Pack a probability vector, or only its top-k entries, into bytes."""
+    dtype = np.dtype(dtype)
+    if dtype not in _DTYPE_CODES:
+        raise ValueError(f"Unsupported dtype {dtype}, expected one of float16, float32")
+    if top_k is not None and top_k < 1:
+        raise ValueError(f"top_k must be at least 1, got {top_k}")
+
+    flags = 0
+    indices = None
+    if top_k is not None and top_k < probabilities.shape[-1]:
+        flags |= FLAG_INDICES
+        indices = np.argpartition(probabilities, -top_k, axis=-1)[..., -top_k:]
+        values = np.take_along_axis(probabilities, indices, axis=-1)
+        order = np.argsort(-values, axis=-1)
+        indices = np.take_along_axis(indices, order, axis=-1).astype("<i4")
+        values = np.take_along_axis(values, order, axis=-1)
+    else:
+        values = probabilities
+    values = np.ascontiguousarray(values, dtype=dtype.newbyteorder("<"))
+
+    model_id_bytes = model_id.encode()
+    parts = [
+        _HEADER.pack(
+            _MAGIC,
+            _VERSION,
+            _DTYPE_CODES[dtype],
+            flags,
+            values.ndim,
+            len(model_id_bytes),
+        ),
+        model_id_bytes,
+        b"\0" * _pad(len(model_id_bytes)),
+        np.asarray(values.shape, dtype="<u4").tobytes(),
+    ]
+    if indices is not None:
+        parts.append(indices.tobytes())
+    parts.append(values.tobytes())
+    return b"".join(parts)
+
+
+def decode_prediction(payload: bytes) -> TensorPrediction:
+    """Inverse of encode_prediction, the arrays are read-only views on payload."""
+    magic, version, dtype_code, flags, ndim, model_id_length = _HEADER.unpack_from(
+        payload
+    )
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError(f"Not a prediction tensor payload (version {version})")
+
+    offset = _HEADER.size
+    model_id = bytes(payload[offset : offset + model_id_length]).decode()
+    offset += model_id_length + _pad(model_id_length)
+
+    shape = tuple(int(dim) for dim in np.frombuffer(payload, "<u4", ndim, offset))
+    offset += 4 * ndim
+    count = int(np.prod(shape))
+
+    indices = None
+    if flags & FLAG_INDICES:
+        indices = np.frombuffer(payload, "<i4", count, offset).reshape(shape)
+        offset += 4 * count
+
+    dtype = _CODE_DTYPES[dtype_code].newbyteorder("<")
+    values = np.frombuffer(payload, dtype, count, offset).reshape(shape)
+    return TensorPrediction(model_id=model_id, values=values, indices=indices)
+
+
+@dataclass
+class TensorRequest:
+    model_id: str
+    image: NDArray
+    dtype: np.dtype
+    top_k: int | None = None
+
+
+def encode_request(
+    model_id: str,
+    image: NDArray | bytes,
+    shape: tuple[int, ...] | None = None,
+    top_k: int | None = None,
+    dtype: type = np.float16,
+) -> bytes:
+    """Pack a uint8 image and the reply options, shape is required for bytes."""
+    dtype = np.dtype(dtype)
+    if dtype not in _DTYPE_CODES:
+        raise ValueError(f"Unsupported dtype {dtype}, expected one of float16, float32")
+    if isinstance(image, np.ndarray):
+        shape = image.shape
+        image = np.ascontiguousarray(image, dtype=np.uint8).tobytes()
+    if shape is None:
+        raise ValueError("The shape of a raw image buffer is required")
+
+    model_id_bytes = model_id.encode()
+    parts = [
+        _HEADER.pack(
+            _REQUEST_MAGIC,
+            _VERSION,
+            _DTYPE_CODES[dtype],
+            FLAG_TOP_K if top_k is not None else 0,
+            len(shape),
+            len(model_id_bytes),
+        ),
+        model_id_bytes,
+        b"\0" * _pad(len(model_id_bytes)),
+    ]
+    if top_k is not None:
+        parts.append(struct.pack("<I", top_k))
+    parts.append(np.asarray(shape, dtype="<u4").tobytes())
+    parts.append(image)
+    return b"".join(parts)
+
+
+def decode_request(payload: bytes) -> TensorRequest:
+    """Inverse of encode_request, the image is a read-only view on payload."""
+    magic, version, dtype_code, flags, ndim, model_id_length = _HEADER.unpack_from(
+        payload
+    )
+    if magic != _REQUEST_MAGIC or version != _VERSION:
+        raise ValueError(f"Not a tensor request payload (version {version})")
+
+    offset = _HEADER.size
+    model_id = bytes(payload[offset : offset + model_id_length]).decode()
+    offset += model_id_length + _pad(model_id_length)
+
+    top_k = None
+    if flags & FLAG_TOP_K:
+        (top_k,) = struct.unpack_from("<I", payload, offset)
+        offset += 4
+
+    shape = tuple(int(dim) for dim in np.frombuffer(payload, "<u4", ndim, offset))
+    offset += 4 * ndim
+    image = np.frombuffer(payload, np.uint8, int(np.prod(shape)), offset)
+    return TensorRequest(
+        model_id=model_id,
+        image=image.reshape(shape),
+        dtype=_CODE_DTYPES[dtype_code],
+        top_k=top_k,
+    )
+
+
+def format_sizes(sizes: list[tuple[int, int]]) -> str:
+    return ",".join(f"{height}x{width}" for height, width in sizes)
+
+
+def parse_sizes(value: str | None) -> list[tuple[int, int]]:
+    """(height, width) list of a sizes header, ValueError when malformed."""
+    if not value:
+        return []
+    sizes = []
+    for item in value.split(","):
+        height, _, width = item.strip().lower().partition("x")
+        size = (int(height), int(width))
+        check_image_size(size)
+        sizes.append(size)
+    if len(sizes) > MAX_IMAGE_SIZES:
+        raise ValueError(f"More than {MAX_IMAGE_SIZES} image sizes")
+    return list(dict.fromkeys(sizes))
+
+
+def check_image_size(size: tuple[int, ...]):
+    """ValueError unless each side is within [MIN_IMAGE_SIDE, MAX_IMAGE_SIDE]."""
+    if not all(MIN_IMAGE_SIDE <= side <= MAX_IMAGE_SIDE for side in size):
+        raise ValueError(
+            f"Image size {size} out of bounds [{MIN_IMAGE_SIDE}, {MAX_IMAGE_SIDE}]"
+        )
+
+
+def square_size(length: int) -> tuple[int, int]:
+    """
+    Size of a square RGB frame of length bytes, ValueError if there is none
+    or its side is out of bounds.
+    """
+    side = math.isqrt(length // 3)
+    if side == 0 or side * side * 3 != length:
+        raise ValueError(f"{length} bytes is not a square RGB frame")
+    check_image_size((side, side))
+    return side, side
+
+
+def split_images(
+    body: bytes, sizes: list[tuple[int, int]]
+) -> dict[tuple[int, int], bytes]:
+    """
+    Frames of a request body by size. Without sizes the body is one square
+    frame, as sent before the sizes header existed.
+    """
+    if not sizes:
+        return {square_size(len(body)): body}
+    expected = sum(height * width * 3 for height, width in sizes)
+    if len(body) != expected:
+        raise ValueError(f"Expected {expected} bytes for {sizes}, got {len(body)}")
+    images = {}
+    offset = 0
+    for height, width in sizes:
+        length = height * width * 3
+        images[(height, width)] = body[offset : offset + length]
+        offset += length
+    return images
+
+
+def split_batch(
+    body: bytes, sizes: list[tuple[int, int]], count: int
+) -> list[dict[tuple[int, int], bytes]]:
+    """Frames of each of the count images of a batch body, see split_images."""
+    if count <= 0 or len(body) % count:
+        raise ValueError(f"{len(body)} bytes can't hold {count} images of {sizes}")
+    length = len(body) // count
+    return [
+        split_images(body[offset : offset + length], sizes)
+        for offset in range(0, len(body), length)
+    ]
+
+
+def negotiate(accept: str | None) -> dict | None:
+    """
+    Read the tensor response options out of an Accept header.
+
+    `Accept: application/x-prediction-tensor; dtype=float32; top_k=5` gives
+    {"dtype": np.float32, "top_k": 5}, None when the media type isn't accepted
+    (or refused with q=0). ValueError for a top_k below 1.
+    """
+    if not accept:
+        return None
+    for media_range in accept.split(","):
+        media_type, *params = (part.strip() for part in media_range.split(";"))
+        if media_type != MEDIA_TYPE:
+            continue
+        options = {"dtype": np.float16, "top_k": None}
+        for param in params:
+            key, _, value = param.partition("=")
+            if key == "dtype":
+                options["dtype"] = np.dtype(value)
+            elif key == "top_k":
+                options["top_k"] = int(value)
+                if options["top_k"] < 1:
+                    raise ValueError(f"top_k must be at least 1, got {value}")
+            elif key == "q" and float(value) == 0:
+                return None
+        return options
+    return None
+
+
+def accept_header(dtype: str = "float16", top_k: int | None = None) -> str:
+    """Accept header asking for the tensor response, JSON stays acceptable."""
+    params = [f"dtype={dtype}"]
+    if top_k is not None:
+        params.append(f"top_k={top_k}")
+    return f"{MEDIA_TYPE}; {'; '.join(params)}, application/json; q=0.5"
@@ -11,6 +11,8 @@ def setup_otel(service_name: str):
     Configure OpenTelemetry logging and tracing for the given service.
     - Always enables console logging.
     - Optionally sends logs and traces to an OTEL collector if OTEL_ENDPOINT is set.
+    - Metrics are exported to the same collector if OTEL_ENDPOINT is set,
+      services record them through `opentelemetry.metrics.get_meter`.
     - Tracing only activates if MANUAL_TRACING is set (for explicit control).
     """
 
@@ -18,11 +20,16 @@ def setup_otel(service_name: str):
     import os
     import platform
 
-    from opentelemetry import _logs, trace
+    from opentelemetry import _logs, metrics, trace
     from opentelemetry.exporter.otlp.proto.grpc._log_exporter import OTLPLogExporter
+    from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import (
+        OTLPMetricExporter,
+    )
     from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
     from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
     from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
     from opentelemetry.sdk.resources import SERVICE_NAME, Resource
     from opentelemetry.sdk.trace import TracerProvider
     from opentelemetry.sdk.trace.export import BatchSpanProcessor
@@ -71,6 +78,17 @@ def setup_otel(service_name: str):
             "⚠️ OTEL_ENDPOINT not set — logs will only go to console."
         )
 
+    # --- OpenTelemetry Metrics Setup ---
+    # NOTE: without a provider the metrics API is a no-op, so services can
+    # always record metrics
+    if otel_endpoint:
+        metric_reader = PeriodicExportingMetricReader(
+            OTLPMetricExporter(endpoint=otel_endpoint)
+        )
+        metrics.set_meter_provider(
+            MeterProvider(resource=resource, metric_readers=[metric_reader])
+        )
+
     if os.environ.get("MANUAL_TRACING"):
         if not otel_endpoint:
             raise RuntimeError(
@@ -122,3 +140,75 @@ def load_config(file_path: str) -> dict | None:
             return None
     except yaml.YAMLError as exc:
         print(exc)
+
+
+def create_client_session(
+    service_name: str, http_config: dict | None = None, **session_kwargs
+):
+    """
+    Create a long-lived aiohttp session backed by a pooled keep-alive connector.
+
+    Meant to be created once per app in the FastAPI lifespan (and closed on
+    shutdown) so requests reuse TCP connections and cached DNS answers.
+    `http_config` takes the `http_client` section of the service config:
+    limit, limit_per_host, keepalive_timeout, ttl_dns_cache (seconds) and
+    timeout (total seconds per request). Pool usage is exported as
+    `http.client.pool.*` metrics. Must be called from a running event loop.
+    """
+
+    import aiohttp
+    from opentelemetry import metrics
+
+    http_config = http_config or {}
+    connector = aiohttp.TCPConnector(
+        limit=http_config.get("limit", 100),
+        limit_per_host=http_config.get("limit_per_host", 32),
+        keepalive_timeout=http_config.get("keepalive_timeout", 30),
+        use_dns_cache=True,
+        ttl_dns_cache=http_config.get("ttl_dns_cache", 300),
+    )
+
+    meter = metrics.get_meter(service_name)
+    connections = meter.create_counter(
+        "http.client.pool.connections",
+        description="Connections handed out by the pool (new, reused, queued)",
+    )
+    dns_lookups = meter.create_counter(
+        "http.client.pool.dns_lookups", description="DNS cache hits and misses"
+    )
+
+    def count(counter, attributes: dict):
+        async def on_event(session, trace_config_ctx, params):
+            counter.add(1, attributes)
+
+        return on_event
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(count(connections, {"state": "new"}))
+    trace_config.on_connection_reuseconn.append(count(connections, {"state": "reused"}))
+    # Requests waiting for a free connection, the pool limits are too low
+    trace_config.on_connection_queued_start.append(
+        count(connections, {"state": "queued"})
+    )
+    trace_config.on_dns_cache_hit.append(count(dns_lookups, {"result": "hit"}))
+    trace_config.on_dns_cache_miss.append(count(dns_lookups, {"result": "miss"}))
+
+    def observe_pool(options):
+        # NOTE: aiohttp has no public API for the pool state
+        yield metrics.Observation(len(connector._acquired), {"state": "in_use"})
+        yield metrics.Observation(
+            sum(len(idle) for idle in connector._conns.values()), {"state": "idle"}
+        )
+
+    meter.create_observable_gauge(
+        "http.client.pool.usage",
+        callbacks=[observe_pool],
+        description="Open connections of the pool by state",
+    )
+
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=http_config.get("timeout")),
+        trace_configs=[trace_config],
+        **session_kwargs,
+    )